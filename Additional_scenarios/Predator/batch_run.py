@@ -1,6 +1,9 @@
+import os
+import sys
 from model import FoodModel
-from mesa.batchrunner import batch_run
-import pandas as pd
+# the batch runner is shared by all the scenarios and lives in the root of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../.."))
+from batch_stream import stream_batch_run, read_results
 from mesa.visualization.modules import CanvasGrid
 from mesa.visualization.ModularVisualization import ModularServer
 from mesa.visualization.UserParam import UserSettableParameter
@@ -12,14 +15,17 @@ if __name__ == '__main__':
               "nf": range(150, 200, 10),
               "sight" : range(15,20,2),
               "width": 100, "height": 100}
-    results = batch_run(
+    stream_batch_run(
         FoodModel,
         parameters=params,
+        path="result.csv",
         iterations=5,
         max_steps=100,
         number_processes=None,
         data_collection_period=-1,
         display_progress=True,
+        # True to complete an interrupted run of the same sweep instead of overwriting the output
+        resume=False,
     )
-    results_df = pd.DataFrame(results)
+    results_df = read_results("result.csv")
 #prova
@@ -0,0 +1,303 @@
+import os
+import json
+import queue
+import threading
+from functools import partial
+from multiprocessing import Pool
+
+import pandas as pd
+from mesa.batchrunner import _make_model_kwargs, _collect_data
+from tqdm import tqdm
+
+
+class _RunWriter(threading.Thread):
+    """
+    Background thread appending the rows of the completed runs to the output, one chunk per run.
+
+    Output can be a csv file or a parquet directory (path ending with ".parquet"), in which every run is
+    written as a separate part file.
+    A sidecar file (path + ".done") keeps track of the completed runs together with their parameters and, for
+    csv outputs, the size of the csv file and the number of rows after each run, in this way a partially written
+    run can be discarded when an interrupted sweep is resumed, and a different sweep is not mistaken for it.
+    """
+
+    def __init__(self, path, max_queued=8):
+        """
+        :param path: output path, csv file or parquet directory
+        :type path: str
+        :param max_queued: maximum number of runs waiting to be written
+        :type max_queued: int
+        """
+        super().__init__(daemon=True)
+        self.path = path
+        self.parquet = path.endswith(".parquet")
+        self.done_path = path + ".done"
+        self.queue = queue.Queue(max_queued)
+        self.error = None
+        self.columns = None
+        self.rows = 0
+
+    def completed_runs(self, keys):
+        """
+        Runs already written to the output, the csv file is truncated after the last completed run
+
+        :param keys: parameters of each run of the sweep, as returned by _run_key, by RunId
+        :type keys: dict
+        :raises ValueError: if the output was written by a sweep with different parameters
+        :return: RunId of the completed runs
+        :rtype: set
+        """
+        records = []
+        if os.path.exists(self.done_path):
+            with open(self.done_path) as f:
+                records = [line.split(",", 3) for line in f.read().splitlines() if line]
+        # the output is missing, nothing to resume
+        if not records or not os.path.exists(self.path):
+            self.reset()
+            return set()
+
+        for run_id, _, _, key in records:
+            if keys.get(int(run_id)) != key:
+                raise ValueError(f"{self.path} was written by a different sweep (run {run_id}: {key}), "
+                                 f"use another path or resume=False to overwrite it")
+
+        if self.parquet:
+            # a part file written without its record is incomplete and will be overwritten
+            return {int(r[0]) for r in records
+                    if os.path.exists(os.path.join(self.path, f"part-{int(r[0]):05d}.parquet"))}
+
+        with open(self.path, "r+b") as f:
+            f.truncate(int(records[-1][1]))
+        self.rows = int(records[-1][2])
+        self.columns = list(pd.read_csv(self.path, index_col=0, nrows=0).columns)
+        return {int(r[0]) for r in records}
+
+    def reset(self):
+        """
+        Removing any previous output
+        """
+        if self.parquet and os.path.isdir(self.path):
+            for f in os.listdir(self.path):
+                os.remove(os.path.join(self.path, f))
+        for p in (self.path, self.done_path):
+            if os.path.isfile(p):
+                os.remove(p)
+
+    def put(self, run_id, key, rows):
+        """
+        Queue the rows of a completed run, blocks if too many runs are waiting to be written
+
+        :param run_id: identifier of the run
+        :type run_id: int
+        :param key: parameters of the run, as returned by _run_key
+        :type key: str
+        :param rows: collected data of the run
+        :type rows: list of dict
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((run_id, key, rows))
+
+    def close(self):
+        """
+        Wait for all queued runs to be written
+        """
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    self.write(*item)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, run_id, key, rows):
+        """
+        Append the rows of a run to the output
+
+        :param run_id: identifier of the run
+        :type run_id: int
+        :param key: parameters of the run, as returned by _run_key
+        :type key: str
+        :param rows: collected data of the run
+        :type rows: list of dict
+        """
+        df = pd.DataFrame(rows)
+
+        if self.parquet:
+            os.makedirs(self.path, exist_ok=True)
+            # hidden temporary file, renamed only once completely written
+            tmp = os.path.join(self.path, f".part-{run_id:05d}.tmp")
+            df.to_parquet(tmp)
+            os.replace(tmp, os.path.join(self.path, f"part-{run_id:05d}.parquet"))
+            size = 0
+            self.rows += len(df)
+        else:
+            # rows keep a global index, as pandas does when saving the whole batch at once
+            header = self.columns is None
+            if header:
+                self.columns = list(df.columns)
+            df = df.reindex(columns=self.columns)
+            df.index = range(self.rows, self.rows + len(df))
+            with open(self.path, "a", newline="") as f:
+                df.to_csv(f, header=header)
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+            self.rows += len(df)
+
+        with open(self.done_path, "a") as f:
+            f.write(f"{run_id},{size},{self.rows},{key}\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def _run_key(iteration, kwargs):
+    """
+    Parameters identifying a run, recorded with the completed runs to recognize the same sweep when resuming
+
+    :param iteration: iteration of the run
+    :type iteration: int
+    :param kwargs: model kwargs of the run
+    :type kwargs: dict
+    :return: json encoding of the iteration and of the kwargs
+    :rtype: str
+    """
+    return json.dumps({"iteration": iteration, **kwargs}, sort_keys=True, default=str)
+
+
+def _collection_steps(steps, data_collection_period):
+    """
+    Steps at which data are collected, the same of mesa.batchrunner
+
+    :param steps: number of steps of the run
+    :type steps: int
+    :param data_collection_period: number of steps after which data gets collected, -1 for the end of episode
+    :type data_collection_period: int
+    :return: collected steps
+    :rtype: list
+    """
+    collected = list(range(0, steps, data_collection_period))
+    if not collected or collected[-1] != steps - 1:
+        collected.append(steps - 1)
+    return collected
+
+
+def _run(model_cls, max_steps, data_collection_period, fill, run):
+    """
+    Single model run, executed by the pool workers, same as mesa.batchrunner._model_run_func.
+    If the model stops before max_steps and fill is set, the last collected values (all the agents rows, if
+    there are agent reporters) are repeated for the missing steps. Every row records the step at which the model
+    stopped (stop_step, set by a ConvergenceMonitor, None if it ran until max_steps), so the repeated rows are the
+    ones with Step > stop_step
+
+    :param run: RunId, iteration and model kwargs
+    :type run: tuple
+    :return: RunId and collected rows
+    :rtype: tuple
+    """
+    run_id, iteration, kwargs = run
+    model = model_cls(**kwargs)
+    while model.running and model.schedule.steps <= max_steps:
+        model.step()
+
+    stop_step = getattr(model, "stop_step", None)
+    rows = []
+    for step in _collection_steps(model.schedule.steps, data_collection_period):
+        model_data, all_agents_data = _collect_data(model, step)
+        # one row per agent if there are agent reporters, otherwise a single row for the step
+        step_rows = [{"RunId": run_id, "iteration": iteration, "Step": step, "stop_step": stop_step, **kwargs,
+                      **model_data, **agent_data} for agent_data in all_agents_data or [{}]]
+        rows.extend(step_rows)
+
+    if fill and data_collection_period != -1:
+        last = step_rows[0]["Step"]
+        rows.extend({**row, "Step": step} for step in _collection_steps(max_steps + 1, data_collection_period)
+                    if step > last for row in step_rows)
+    return run_id, rows
+
+
+def stream_batch_run(model_cls, parameters, path, number_processes=None, iterations=1,
+                     data_collection_period=-1, max_steps=1000, display_progress=True, resume=False, fill=False):
+    """
+    Batch run of a mesa model, same as mesa.batchrunner.batch_run but the data of each run are written to
+    disk by a background thread as soon as the run is completed, instead of being kept in memory until the end.
+    RunId depends only on the position of the run in the sweep, so an interrupted sweep can be resumed
+    running only the missing runs; the parameters of each completed run are recorded and checked when resuming,
+    so that the output of a different sweep is never extended.
+
+    :param model_cls: the model class to batch-run
+    :type model_cls: Type[Model]
+    :param parameters: dictionary with model parameters over which to run the model, single values or iterables
+    :type parameters: dict
+    :param path: output csv file, or directory of parquet files if it ends with ".parquet" (requires pyarrow)
+    :type path: str
+    :param number_processes: number of processes used, None to use all available processors, defaults to None
+    :type number_processes: int, optional
+    :param iterations: number of iterations for each parameter combination, defaults to 1
+    :type iterations: int, optional
+    :param data_collection_period: number of steps after which data gets collected, defaults to -1 (end of episode)
+    :type data_collection_period: int, optional
+    :param max_steps: maximum number of model steps after which the model halts, defaults to 1000
+    :type max_steps: int, optional
+    :param display_progress: display batch run process, defaults to True
+    :type display_progress: bool, optional
+    :param resume: skip the runs already written to path by the same sweep, otherwise path is overwritten,
+    defaults to False
+    :type resume: bool, optional
+    :param fill: forward-fill the runs stopped before max_steps (e.g. by a ConvergenceMonitor) with their last
+    collected values, so that all the runs have the same steps (the stop_step column tells the repeated rows
+    apart), defaults to False
+    :type fill: bool, optional
+    """
+    kwargs_list = _make_model_kwargs(parameters)
+    runs = [(iteration * len(kwargs_list) + i, iteration, kwargs)
+            for iteration in range(iterations) for i, kwargs in enumerate(kwargs_list)]
+
+    keys = {run_id: _run_key(iteration, kwargs) for run_id, iteration, kwargs in runs}
+
+    writer = _RunWriter(path)
+    if resume:
+        completed = writer.completed_runs(keys)
+        runs = [run for run in runs if run[0] not in completed]
+    else:
+        writer.reset()
+    writer.start()
+
+    process_func = partial(_run, model_cls, max_steps, data_collection_period, fill)
+
+    try:
+        with tqdm(total=len(runs), disable=not display_progress) as pbar:
+            if number_processes == 1:
+                for run in runs:
+                    run_id, rows = process_func(run)
+                    writer.put(run_id, keys[run_id], rows)
+                    pbar.update()
+            else:
+                with Pool(number_processes) as p:
+                    for run_id, rows in p.imap_unordered(process_func, runs):
+                        writer.put(run_id, keys[run_id], rows)
+                        pbar.update()
+    finally:
+        writer.close()
+
+
+def read_results(path):
+    """
+    Load the results written by stream_batch_run
+
+    :param path: output csv file, or directory of parquet files if it ends with ".parquet"
+    :type path: str
+    :return: all the collected data
+    :rtype: pd.DataFrame
+    """
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    return pd.read_csv(path, index_col=0)
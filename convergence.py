@@ -0,0 +1,63 @@
+class ConvergenceMonitor:
+    """
+    Detects when a generational run has reached a steady state, looking at the model variables collected by the
+    DataCollector:
+    - absorbing state: the last collected value of one of the monitored variables is an absorbing value
+      (e.g. fixation or loss of an allele without mutation)
+    - stationary state: the values of each monitored variable over the last window collected steps stay within
+      a band of width tol
+
+    When the steady state is reached the run is stopped (model.running = False) and the last collected step is
+    recorded in model.stop_step.
+
+    Shared by the kinship and the green beard models.
+    """
+
+    def __init__(self, window, tol=0.01, columns=("altruistic fraction",), absorbing=()):
+        """
+        :param window: number of collected steps of the rolling window, 0 to check only the absorbing states
+        :type window: int
+        :param tol: maximum width of the band of the values in the window, defaults to 0.01
+        :type tol: float, optional
+        :param columns: model variables to be monitored, defaults to ("altruistic fraction",)
+        :type columns: tuple, optional
+        :param absorbing: absorbing values of the monitored variables, defaults to ()
+        :type absorbing: tuple, optional
+        """
+        self.window = window
+        self.tol = tol
+        self.columns = columns
+        self.absorbing = absorbing
+
+    def converged(self, model):
+        """
+        Check if the model has reached a steady state
+
+        :param model: the model, with the data of the last step already collected
+        :type model: mesa.model
+        :return: True if the run has reached an absorbing or stationary state
+        :rtype: bool
+        """
+        model_vars = model.datacollector.model_vars
+        if any(model_vars[c][-1] in self.absorbing for c in self.columns):
+            return True
+        if self.window <= 0 or len(model_vars[self.columns[0]]) < self.window:
+            return False
+        return all(max(model_vars[c][-self.window:]) - min(model_vars[c][-self.window:]) <= self.tol
+                   for c in self.columns)
+
+    def update(self, model):
+        """
+        To be called at the end of each model step, after the data collection: stops the run if it has reached
+        a steady state
+
+        :param model: the model
+        :type model: mesa.model
+        :return: True if the run has been stopped
+        :rtype: bool
+        """
+        if model.running and self.converged(model):
+            model.running = False
+            model.stop_step = len(model.datacollector.model_vars[self.columns[0]]) - 1
+            return True
+        return False
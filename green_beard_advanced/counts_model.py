@@ -0,0 +1,253 @@
+from mesa import Model
+from mesa.time import BaseScheduler
+from mesa.datacollection import DataCollector
+import numpy as np
+
+# genotype classes, in the order of the counts: [gene1, gene2]
+TRUE_BEARD, SUCKER, IMPOSTOR, COWARD = range(4)
+GENOTYPES = np.array([[1, 1], [1, 0], [0, 1], [0, 0]])
+
+
+def multivariate_hypergeometric(rng, counts, nsample):
+    """
+    Sampling without replacement of nsample individuals from a population described by the counts of its classes,
+    for many populations at once: one hypergeometric draw for each class, vectorized over the populations
+
+    :param rng: random number generator
+    :type rng: np.random.Generator
+    :param counts: number of individuals of each class, one row for each population
+    :type counts: np.ndarray of shape (R, K)
+    :param nsample: number of individuals to be sampled from each population
+    :type nsample: np.ndarray of shape (R,)
+    :return: number of sampled individuals of each class
+    :rtype: np.ndarray of shape (R, K)
+    """
+    sample = np.zeros_like(counts)
+    left = counts.sum(axis=1)
+    nsample = np.array(nsample, dtype=counts.dtype)
+    for k in range(counts.shape[1] - 1):
+        left = left - counts[:, k]
+        sample[:, k] = rng.hypergeometric(counts[:, k], left, nsample)
+        nsample = nsample - sample[:, k]
+    sample[:, -1] = nsample
+    return sample
+
+
+class CountsBeardModel(Model):
+    """
+    Aggregate version of the BeardModelAdv.
+    Apart from their genotype the agents are interchangeable, so each population is described only by the
+    number of true beards, suckers, impostors and cowards. Rooms, deaths and reproduction are drawn as
+    multinomial and hypergeometric samples of these counts, so the cost of a step does not depend on N and
+    many independent replicates are simulated at once.
+    The life cycle and the parameters are the same of the BeardModelAdv, the collected fractions are the mean
+    across the replicates.
+
+    :param Model: the model class for Mesa framework
+    :type Model: mesa.model
+    """
+
+    def __init__(self, N=500, r=0.25, dr=0.95, mr=0.001, cr=0, linkage_dis=False, replicates=1):
+        """
+        Aggregate version of the BeardModelAdv
+
+        :param N: total number of agents, defaults to 500
+        :type N: int, optional
+        :param r: initial ratio of altruistic allele, defaults to 0.25
+        :type r: float, optional
+        :param dr: death rate for sacrificing altruist, defaults to 0.95
+        :type dr: float, optional
+        :param mr: mutation rate, defaults to 0.001
+        :type mr: float, optional
+        :param cr: cross-over rate, defaults to 0
+        :type cr: float, optional
+        :param linkage_dis: flag to preform linkage equilibrium or disequilibrium simulation, defaults to False
+        :type linkage_dis: bool, optional
+        :param replicates: number of independent populations simulated together, defaults to 1
+        :type replicates: int, optional
+        """
+
+        super().__init__()
+        # the scheduler holds no agent, it is only used to keep track of the steps
+        self.schedule = BaseScheduler(self)
+        self.rng = np.random.default_rng(self._seed)
+        self.N = N
+        self.r = r
+        self.mr = mr
+        self.dr = dr
+        self.cr = cr
+        self.linkage_dis = linkage_dis
+        self.replicates = replicates
+
+        self.running = True
+        self.datacollector = DataCollector(model_reporters={
+            "altruistic fraction": lambda x: x.fraction(TRUE_BEARD, SUCKER),
+            "true beards fraction": lambda x: x.fraction(TRUE_BEARD),
+            "suckers fraction": lambda x: x.fraction(SUCKER),
+            "impostors fraction": lambda x: x.fraction(IMPOSTOR),
+            "cowards fraction": lambda x: x.fraction(COWARD),
+            "n_agents": lambda x: x.counts.sum(axis=1).mean()})
+
+        self.add_agents(N, r, linkage_dis)
+        self.reproduce()
+
+    def add_agents(self, N, r, linkage_dis):
+        """
+        Initial counts of each genotype, the same of BeardModelAdv.add_agents
+
+        :param N: total number of agents
+        :type N: int
+        :param r: initial ratio of altruistic allele
+        :type r: float
+        :param linkage_dis: flag to preform linkage equilibrium or disequilibrium simulation
+        :type linkage_dis: bool
+        """
+        if not linkage_dis:
+            # initialization without linkage disequilibrium
+            counts = [int(N * r), int(N * r), int(N * r), N + 1 - 3 * int(N * r)]
+        else:
+            # initialization for linkage disequilibrium
+            counts = [int(N * r), 0, 0, N - int(N * r)]
+        self.counts = np.tile(np.array(counts, dtype=np.int64), (self.replicates, 1))
+
+    def fraction(self, *genotypes):
+        """
+        Fraction of agents with the given genotypes, mean across the replicates which are not extinct
+
+        :param genotypes: genotype classes (TRUE_BEARD, SUCKER, IMPOSTOR, COWARD)
+        :type genotypes: int
+        :return: mean fraction
+        :rtype: float
+        """
+        total = self.counts.sum(axis=1)
+        alive = total > 0
+        if not alive.any():
+            return float("nan")
+        return (self.counts[alive][:, list(genotypes)].sum(axis=1) / total[alive]).mean()
+
+    def fixation_probability(self, gene=0):
+        """
+        Fraction of the replicates in which the allele 1 of the given gene is fixed (or lost if the fraction
+        is computed for the allele 0), extinct populations are not considered
+
+        :param gene: 0 for the altruistic gene, 1 for the green beard gene, defaults to 0
+        :type gene: int, optional
+        :return: fraction of replicates with the allele fixed and fraction of replicates with the allele lost
+        :rtype: tuple
+        """
+        total = self.counts.sum(axis=1)
+        carriers = self.counts[:, GENOTYPES[:, gene] == 1].sum(axis=1)
+        alive = total > 0
+        if not alive.any():
+            return float("nan"), float("nan")
+        return (carriers[alive] == total[alive]).mean(), (carriers[alive] == 0).mean()
+
+    def reproduce(self, max_child=4):
+        """
+        Function to generate the new population from the parent individuals
+        1. Generate random pairs of individuals: the first and the second member of the pairs are sampled without
+           replacement, then they are randomly matched. With an odd population the unpaired individual survives
+        2. Draw the number of children of each pair
+        3. Define the inherited genotype of the children: cross-over ([gene1 of the first parent, gene2 of the
+           second parent]) with probability cr, otherwise the genotype of a random parent
+        4. Apply mutation to each gene and replace the "old" counts with the new generation
+        """
+        rng = self.rng
+        # 1
+        pairs = self.counts.sum(axis=1) // 2
+        agent1 = multivariate_hypergeometric(rng, self.counts, pairs)
+        agent2 = multivariate_hypergeometric(rng, self.counts - agent1, pairs)
+        leftover = self.counts - agent1 - agent2
+
+        # 2, 3
+        children = leftover.copy()
+        partners = agent2.copy()
+        for i in range(4):
+            # partners of the first parents of genotype i
+            matched = multivariate_hypergeometric(rng, partners, agent1[:, i])
+            partners -= matched
+            for j in range(4):
+                # number of pairs with 2, 3 ... max_child children
+                n_child = rng.multinomial(matched[:, j], np.full(max_child - 1, 1 / (max_child - 1)))
+                n_child = n_child @ np.arange(2, max_child + 1)
+                # genotype classes of the children: cross-over, first parent, second parent
+                cross = 3 - (GENOTYPES[i, 0] * 2 + GENOTYPES[j, 1])
+                child_genotype = [cross, i, j]
+                inherited = rng.multinomial(n_child, [self.cr, (1 - self.cr) / 2, (1 - self.cr) / 2])
+                for k in range(3):
+                    children[:, child_genotype[k]] += inherited[:, k]
+
+        # 4
+        # flipping gene2 and/or gene1, in terms of the genotype class it is a XOR with 1 and/or 2
+        flips = [(1 - self.mr) ** 2, (1 - self.mr) * self.mr, self.mr * (1 - self.mr), self.mr ** 2]
+        counts = np.zeros_like(children)
+        for g in range(4):
+            mutated = rng.multinomial(children[:, g], flips)
+            for flip in range(4):
+                counts[:, g ^ flip] += mutated[:, flip]
+        self.counts = counts
+
+    def step(self) -> None:
+        """
+        Model step, see BeardModelAdv.step.
+        Each agent enters one of the rooms with the same probability, so the number of agents in a room follows
+        a binomial distribution (n agents, probability 1/n) and the number of dangerous rooms with one agent and
+        with at least two agents is drawn from a multinomial. The agents in those rooms (only the first two of
+        each room) are sampled without replacement:
+        - agents alone in a room die
+        - if the first agent is altruist and the second has the green beard the first one dies with probability dr,
+          otherwise the second one dies
+        """
+        rng = self.rng
+        num_agents = self.counts.sum(axis=1)
+
+        if not self.linkage_dis:
+            danger_number = num_agents // 1.893
+        else:
+            danger_number = num_agents // 1.9
+        # rooms from 1 to danger_number - 1 are dangerous
+        rooms = np.maximum(danger_number.astype(np.int64) - 1, 0)
+
+        # probability for a room to be empty or to have a single agent
+        n = np.maximum(num_agents, 1)
+        empty = (1 - 1 / n) ** n
+        single = (1 - 1 / n) ** (n - 1)
+        singles = rng.binomial(rooms, single)
+        # with at most one agent left every occupied room is single (single == 1), no couples can be formed
+        couple = np.divide(np.clip(1 - empty - single, 0, 1), 1 - single, out=np.zeros(len(n)), where=single < 1)
+        couples = rng.binomial(rooms - singles, couple)
+        # the rooms cannot host more agents than the population
+        singles = np.minimum(singles, num_agents)
+        couples = np.minimum(couples, (num_agents - singles) // 2)
+
+        alone = multivariate_hypergeometric(rng, self.counts, singles)
+        agent1 = multivariate_hypergeometric(rng, self.counts - alone, couples)
+        agent2 = multivariate_hypergeometric(rng, self.counts - alone - agent1, couples)
+
+        # number of rooms where an altruist first agent meets a bearded second agent
+        altruist1 = agent1[:, [TRUE_BEARD, SUCKER]]
+        bearded2 = agent2[:, [TRUE_BEARD, IMPOSTOR]]
+        helped = rng.hypergeometric(bearded2.sum(axis=1), couples - bearded2.sum(axis=1), altruist1.sum(axis=1))
+
+        # altruists sacrificing themselves with probability dr, all the other second agents die
+        sacrificing = multivariate_hypergeometric(rng, altruist1, helped)
+        saved = multivariate_hypergeometric(rng, bearded2, helped)
+        deaths = alone + agent2
+        deaths[:, [TRUE_BEARD, SUCKER]] += rng.binomial(sacrificing, self.dr)
+        deaths[:, [TRUE_BEARD, IMPOSTOR]] -= saved
+        self.counts = self.counts - deaths
+
+        self.schedule.step()
+
+        self.reproduce()
+        self.datacollector.collect(self)
+
+
+if __name__ == "__main__":
+    model = CountsBeardModel(N=2000, r=0.5, dr=0.95, mr=0.0001, cr=0.0, linkage_dis=True, replicates=1000)
+
+    for i in range(1000):
+        model.step()
+
+    print("Final mean freq TRUE BEARDS:", model.fraction(TRUE_BEARD))
+    print("Fixation and loss probability of the altruistic allele:", model.fixation_probability(0))
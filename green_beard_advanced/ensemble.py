@@ -0,0 +1,257 @@
+from mesa import Model
+from mesa.time import BaseScheduler
+from mesa.datacollection import DataCollector
+from mesa.batchrunner import _make_model_kwargs
+from tqdm import tqdm
+import numpy as np
+
+# genotype codes: bit 0 altruistic gene, bit 1 green beard gene
+TRUE_BEARD, SUCKER, IMPOSTOR, COWARD = 0b11, 0b01, 0b10, 0b00
+
+
+class EnsembleBeardModelAdv(Model):
+    """
+    Ensemble of independent replicates of the BeardModelAdv advanced together.
+    The genotypes of all the replicates are stored in a single (replicates x agents) array, each row padded after
+    the population size of its replicate, so every phase of the life cycle is a single vectorized operation on
+    the whole ensemble. The life cycle and the parameters are the same of the BeardModelAdv.
+    The reporters of the DataCollector collect an array with the value of each replicate.
+
+    :param Model: the model class for Mesa framework
+    :type Model: mesa.model
+    """
+
+    def __init__(self, N=500, r=0.25, dr=0.95, mr=0.001, cr=0, linkage_dis=False, replicates=1):
+        """
+        Ensemble of independent replicates of the BeardModelAdv
+
+        :param N: total number of agents, defaults to 500
+        :type N: int, optional
+        :param r: initial ratio of altruistic allele, defaults to 0.25
+        :type r: float, optional
+        :param dr: death rate for sacrificing altruist, defaults to 0.95
+        :type dr: float, optional
+        :param mr: mutation rate, defaults to 0.001
+        :type mr: float, optional
+        :param cr: cross-over rate, defaults to 0
+        :type cr: float, optional
+        :param linkage_dis: flag to preform linkage equilibrium or disequilibrium simulation, defaults to False
+        :type linkage_dis: bool, optional
+        :param replicates: number of replicates, defaults to 1
+        :type replicates: int, optional
+        """
+
+        super().__init__()
+        # the scheduler holds no agent, it is only used to keep track of the steps
+        self.schedule = BaseScheduler(self)
+        self.rng = np.random.default_rng(self._seed)
+        self.N = N
+        self.r = r
+        self.mr = mr
+        self.dr = dr
+        self.cr = cr
+        self.linkage_dis = linkage_dis
+        self.replicates = replicates
+
+        self.running = True
+        self.datacollector = DataCollector(model_reporters={
+            "altruistic fraction": lambda x: x.fraction(TRUE_BEARD, SUCKER),
+            "true beards fraction": lambda x: x.fraction(TRUE_BEARD),
+            "suckers fraction": lambda x: x.fraction(SUCKER),
+            "impostors fraction": lambda x: x.fraction(IMPOSTOR),
+            "cowards fraction": lambda x: x.fraction(COWARD),
+            "n_agents": lambda x: x.size.copy()})
+
+        self.add_agents(N, r, linkage_dis)
+        self.reproduce()
+
+    def add_agents(self, N, r, linkage_dis):
+        """
+        Add agents to each replicate with the same proportions of genotypes of BeardModelAdv.add_agents
+
+        :param N: total number of agents
+        :type N: int
+        :param r: initial ratio of altruistic allele
+        :type r: float
+        :param linkage_dis: flag to preform linkage equilibrium or disequilibrium simulation
+        :type linkage_dis: bool
+        """
+        n = int(N * r)
+        if not linkage_dis:
+            # initialization without linkage disequilibrium
+            genotype = np.repeat([TRUE_BEARD, SUCKER, IMPOSTOR, COWARD], [n, n, n, N + 1 - 3 * n])
+        else:
+            # initialization for linkage disequilibrium
+            genotype = np.repeat([TRUE_BEARD, COWARD], [n, N - n])
+        self.genotype = np.tile(genotype.astype(np.uint8), (self.replicates, 1))
+        self.size = np.full(self.replicates, len(genotype))
+
+    def valid(self):
+        """
+        Mask of the entries of the genotype array holding an agent
+
+        :return: True for the agents, False for the padding
+        :rtype: np.ndarray of shape (replicates, agents)
+        """
+        return np.arange(self.genotype.shape[1]) < self.size[:, None]
+
+    def fraction(self, *genotypes):
+        """
+        Fraction of agents with the given genotypes in each replicate, nan for extinct replicates
+
+        :param genotypes: genotype codes (TRUE_BEARD, SUCKER, IMPOSTOR, COWARD)
+        :type genotypes: int
+        :return: fraction of each replicate
+        :rtype: np.ndarray
+        """
+        count = (np.isin(self.genotype, genotypes) & self.valid()).sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return count / self.size
+
+    def reproduce(self, max_child=4):
+        """
+        Function to generate the new population of each replicate from the parent individuals
+        1. Shuffle each replicate and generate pairs of individuals
+        2. Draw the number of children of each pair and define their inherited genotype (cross-over and mutation
+           applied)
+        3. Replace the "old" array with the new generation, with an odd population the unpaired individual
+           survives and stays in front of the new generation
+        """
+        rng = self.rng
+        replicates, capacity = self.genotype.shape
+
+        # 1
+        # random permutation of each row, padding goes at the end
+        keys = rng.random((replicates, capacity))
+        keys[~self.valid()] = 2
+        shuffled = np.take_along_axis(self.genotype, np.argsort(keys, axis=1), axis=1)
+        half = self.size // 2
+        pairs = capacity // 2
+        agent1 = shuffled[:, 0:2 * pairs:2]
+        agent2 = shuffled[:, 1:2 * pairs:2]
+
+        # 2
+        n_child = rng.integers(2, max_child + 1, size=(replicates, pairs)) * (np.arange(pairs) < half[:, None])
+        g1 = np.repeat(agent1.ravel(), n_child.ravel())
+        g2 = np.repeat(agent2.ravel(), n_child.ravel())
+        n = len(g1)
+        # cross-over takes the altruistic gene of the first parent and the green beard gene of the second one
+        crossover = (g1 & 0b01) | (g2 & 0b10)
+        child = np.where(rng.random(n) < self.cr, crossover, np.where(rng.random(n) < 0.5, g1, g2))
+        child ^= (rng.random(n) < self.mr).astype(np.uint8) | ((rng.random(n) < self.mr).astype(np.uint8) << 1)
+
+        # 3
+        leftover = self.size % 2
+        children = n_child.sum(axis=1)
+        self.size = leftover + children
+        genotype = np.zeros((replicates, max(self.size.max(), 1)), dtype=np.uint8)
+        odd = np.flatnonzero(leftover)
+        genotype[odd, 0] = shuffled[odd, 2 * half[odd]]
+        row = np.repeat(np.arange(replicates), children)
+        start = np.cumsum(children) - children
+        genotype[row, leftover[row] + np.arange(n) - start[row]] = child
+        self.genotype = genotype
+
+    def step(self) -> None:
+        """
+        Model step of each replicate, see BeardModelAdv.step: each agent is randomly assigned to an
+        "interaction room", only the first two agents entering a dangerous room are considered:
+        - an agent alone in the room dies
+        - if the first agent is altruist and the second has the green beard the first one dies with probability dr,
+          otherwise the second one dies
+        """
+        rng = self.rng
+        replicates, capacity = self.genotype.shape
+        valid = self.valid()
+
+        # creating the "interaction rooms"
+        if not self.linkage_dis:
+            danger_number = self.size // 1.893
+        else:
+            danger_number = self.size // 1.9
+
+        # assign each agent to an "interaction room" of its replicate
+        room = rng.integers(1, np.maximum(self.size, 1)[:, None] + 1, size=(replicates, capacity))
+        in_danger = np.flatnonzero(valid & (room < danger_number[:, None]))
+
+        # rooms are identified by replicate and number, the stable sort keeps the order of the agents within rooms
+        key = (in_danger // capacity) * (capacity + 2) + room.ravel()[in_danger]
+        order = np.argsort(key, kind="stable")
+        in_danger, key = in_danger[order], key[order]
+        first = np.ones(len(in_danger), dtype=bool)
+        first[1:] = key[1:] != key[:-1]
+        second = np.zeros(len(in_danger), dtype=bool)
+        second[1:] = first[:-1] & ~first[1:]
+
+        # capacity-2 rule: agents after the second one of a room are ignored
+        alone = first & ~np.append(second[1:], False)
+        agent1 = in_danger[first & ~alone]
+        agent2 = in_danger[second]
+
+        genotype = self.genotype.ravel()
+        helps = ((genotype[agent1] & 0b01) > 0) & ((genotype[agent2] & 0b10) > 0)
+        sacrifice = helps & (rng.random(len(agent1)) < self.dr)
+
+        alive = valid.ravel().copy()
+        alive[in_danger[alone]] = False
+        alive[agent1[sacrifice]] = False
+        alive[agent2[~helps]] = False
+        alive = alive.reshape(replicates, capacity)
+
+        # survivors are moved at the beginning of each row, keeping their order
+        self.genotype = np.take_along_axis(self.genotype, np.argsort(~alive, axis=1, kind="stable"), axis=1)
+        self.size = alive.sum(axis=1)
+
+        self.schedule.step()
+
+        self.reproduce()
+        self.datacollector.collect(self)
+
+
+def ensemble_batch_run(parameters, iterations=1, data_collection_period=-1, max_steps=1000, display_progress=True):
+    """
+    Batch run of the BeardModelAdv with the ensemble engine: the iterations of each combination of parameters
+    are the replicates of a single EnsembleBeardModelAdv, so they run together in a single process.
+    Returns the same rows of mesa.batchrunner.batch_run (and of stream_batch_run, RunId included).
+
+    :param parameters: dictionary with model parameters over which to run the model, single values or iterables
+    :type parameters: dict
+    :param iterations: number of iterations for each parameter combination, defaults to 1
+    :type iterations: int, optional
+    :param data_collection_period: number of steps after which data gets collected, defaults to -1 (end of episode)
+    :type data_collection_period: int, optional
+    :param max_steps: maximum number of model steps after which the model halts, defaults to 1000
+    :type max_steps: int, optional
+    :param display_progress: display batch run process, defaults to True
+    :type display_progress: bool, optional
+    :return: collected data, one row for each run and collected step
+    :rtype: list of dict
+    """
+    kwargs_list = _make_model_kwargs(parameters)
+    rows = {}
+    for i, kwargs in enumerate(tqdm(kwargs_list, disable=not display_progress)):
+        model = EnsembleBeardModelAdv(replicates=iterations, **kwargs)
+        while model.running and model.schedule.steps <= max_steps:
+            model.step()
+
+        # same steps collected by mesa.batchrunner
+        steps = list(range(0, model.schedule.steps, data_collection_period))
+        if not steps or steps[-1] != model.schedule.steps - 1:
+            steps.append(model.schedule.steps - 1)
+
+        model_vars = model.datacollector.model_vars
+        for iteration in range(iterations):
+            run_id = iteration * len(kwargs_list) + i
+            rows[run_id] = [{"RunId": run_id, "iteration": iteration, "Step": step, **kwargs,
+                             **{name: values[step][iteration].item() for name, values in model_vars.items()}}
+                            for step in steps]
+
+    return [row for run_id in sorted(rows) for row in rows[run_id]]
+
+
+if __name__ == "__main__":
+    import pandas as pd
+
+    params = {"N": 1000, "r": 0.50, "dr": 0.95, "mr": 0.001, "cr": 0.0002, "linkage_dis": True}
+    results = pd.DataFrame(ensemble_batch_run(params, iterations=20, max_steps=1000, data_collection_period=1))
+    print(results)
@@ -0,0 +1,281 @@
+from mesa import Model
+from mesa.time import BaseScheduler
+from mesa.datacollection import DataCollector
+import numpy as np
+
+# position of the loci with a role in the interaction, all the other loci are neutral
+ALTRUISM, BEARD = 0, 1
+
+
+def prefix_parity(x):
+    """
+    Inclusive prefix XOR of the bits of 64 bit words: bit k of the result is the parity of the bits 0..k of x
+
+    :param x: words
+    :type x: np.ndarray of np.uint64
+    :return: prefix parity of each word
+    :rtype: np.ndarray of np.uint64
+    """
+    for shift in (1, 2, 4, 8, 16, 32):
+        x = x ^ (x << np.uint64(shift))
+    return x
+
+
+def pack_bits(bits):
+    """
+    Packs rows of booleans into 64 bit words, column k goes to bit k
+
+    :param bits: booleans, at most 64 columns
+    :type bits: np.ndarray of shape (n, k)
+    :return: packed words
+    :rtype: np.ndarray of np.uint64
+    """
+    weights = np.uint64(1) << np.arange(bits.shape[1], dtype=np.uint64)
+    return (bits.astype(np.uint64) * weights).sum(axis=1, dtype=np.uint64)
+
+
+class MultilocusBeardModel(Model):
+    """
+    Generalization of the BeardModelAdv to a genome of K loci packed in a 64 bit word for each agent:
+    locus 0 is the altruistic gene, locus 1 the green beard gene and the other loci are neutral, linked
+    to the first two according to the recombination map.
+    Individuals are entries of the numpy array of genomes, kept in the same order the BeardModelAdv schedule
+    would have them, so the whole population is updated at once as in the ArrayBeardModel.
+
+    :param Model: the model class for Mesa framework
+    :type Model: mesa.model
+    """
+
+    def __init__(self, N=500, r=0.25, dr=0.95, mr=0.001, recombination=(0,), linkage_dis=False):
+        """
+        Generalization of the BeardModelAdv to a genome of K loci
+
+        :param N: total number of agents, defaults to 500
+        :type N: int, optional
+        :param r: initial ratio of altruistic allele, defaults to 0.25
+        :type r: float, optional
+        :param dr: death rate for sacrificing altruist, defaults to 0.95
+        :type dr: float, optional
+        :param mr: mutation rate, the same for all the loci or one for each locus, defaults to 0.001
+        :type mr: float or list, optional
+        :param recombination: recombination map, probability of a crossover between locus k and k + 1; the number
+        of loci is len(recombination) + 1, at most 64. With the map [cr] the model is the BeardModelAdv with
+        cross-over rate cr, defaults to (0,)
+        :type recombination: list, optional
+        :param linkage_dis: flag to preform linkage equilibrium or disequilibrium simulation, defaults to False
+        :type linkage_dis: bool, optional
+        """
+
+        super().__init__()
+        # the scheduler holds no agent, it is only used to keep track of the steps
+        self.schedule = BaseScheduler(self)
+        self.rng = np.random.default_rng(self._seed)
+        self.N = N
+        self.r = r
+        self.dr = dr
+        self.recombination = np.asarray(recombination, dtype=float)
+        self.loci = len(self.recombination) + 1
+        if self.loci > 64:
+            raise ValueError("At most 64 loci can be packed in the genome")
+        self.mr = np.broadcast_to(np.asarray(mr, dtype=float), (self.loci,))
+        self.linkage_dis = linkage_dis
+
+        self.running = True
+        reporters = {
+            "altruistic fraction": lambda x: x.allele(ALTRUISM).mean(),
+            "true beards fraction": lambda x: (x.allele(ALTRUISM) & x.allele(BEARD)).mean(),
+            "suckers fraction": lambda x: (x.allele(ALTRUISM) & ~x.allele(BEARD)).mean(),
+            "impostors fraction": lambda x: (~x.allele(ALTRUISM) & x.allele(BEARD)).mean(),
+            "cowards fraction": lambda x: (~x.allele(ALTRUISM) & ~x.allele(BEARD)).mean(),
+            "linkage disequilibrium": lambda x: x.linkage_disequilibrium(ALTRUISM, BEARD),
+            "n_agents": lambda x: len(x.genome)}
+        for k in range(2, self.loci):
+            reporters[f"locus {k} frequency"] = lambda x, k=k: x.allele(k).mean()
+        self.datacollector = DataCollector(model_reporters=reporters)
+
+        self.add_agents(N, r, linkage_dis)
+        self.reproduce()
+
+    def add_agents(self, N, r, linkage_dis):
+        """
+        Add agents to the model with the same proportions of genotypes of BeardModelAdv.add_agents,
+        the alleles of the neutral loci are drawn at random with frequency 0.5
+
+        :param N: total number of agents
+        :type N: int
+        :param r: initial ratio of altruistic allele
+        :type r: float
+        :param linkage_dis: flag to preform linkage equilibrium or disequilibrium simulation
+        :type linkage_dis: bool
+        """
+        n = int(N * r)
+        if not linkage_dis:
+            # initialization without linkage disequilibrium: true beards, suckers, impostors, cowards
+            classes = np.repeat([0b11, 0b01, 0b10, 0b00], [n, n, n, N + 1 - 3 * n])
+        else:
+            # initialization for linkage disequilibrium: true beards, cowards
+            classes = np.repeat([0b11, 0b00], [n, N - n])
+        neutral = pack_bits(self.rng.random((len(classes), self.loci)) < 0.5) & ~np.uint64(0b11)
+        self.genome = classes.astype(np.uint64) | neutral
+
+    def get_population(self):
+        """
+        Genomes of the population, used to exchange migrants between demes
+
+        :return: packed genome of each agent
+        :rtype: np.ndarray of np.uint64
+        """
+        return self.genome
+
+    def set_population(self, genome):
+        """
+        Replace the population, used to exchange migrants between demes
+
+        :param genome: packed genome of each agent
+        :type genome: np.ndarray of np.uint64
+        """
+        self.genome = np.asarray(genome, dtype=np.uint64)
+
+    def allele(self, locus):
+        """
+        Allele carried by each agent at a locus
+
+        :param locus: position of the locus
+        :type locus: int
+        :return: True for allele 1
+        :rtype: np.ndarray of bool
+        """
+        return ((self.genome >> np.uint64(locus)) & np.uint64(1)).astype(bool)
+
+    def linkage_disequilibrium(self, locus1, locus2):
+        """
+        Linkage disequilibrium D = p11 - p1 * p2 between the alleles 1 of two loci
+
+        :param locus1: position of the first locus
+        :type locus1: int
+        :param locus2: position of the second locus
+        :type locus2: int
+        :return: linkage disequilibrium
+        :rtype: float
+        """
+        a1, a2 = self.allele(locus1), self.allele(locus2)
+        return (a1 & a2).mean() - a1.mean() * a2.mean()
+
+    def recombine(self, g1, g2):
+        """
+        Recombination of packed genomes: the child starts copying a random parent and switches to the other
+        parent at each crossover point. Crossovers between locus k and k + 1 happen with the probability given by
+        the recombination map, the loci taken from the other parent are the ones with odd prefix parity of the
+        crossover points.
+
+        :param g1: genomes of the first parents
+        :type g1: np.ndarray of np.uint64
+        :param g2: genomes of the second parents
+        :type g2: np.ndarray of np.uint64
+        :return: genomes of the children
+        :rtype: np.ndarray of np.uint64
+        """
+        start = self.rng.random(len(g1)) < 0.5
+        first, other = np.where(start, g1, g2), np.where(start, g2, g1)
+        # crossover between locus k and k + 1 sets bit k + 1 of the switch mask
+        switches = pack_bits(self.rng.random((len(g1), self.loci - 1)) < self.recombination) << np.uint64(1)
+        mask = prefix_parity(switches)
+        return (first & ~mask) | (other & mask)
+
+    def mutate(self, genome):
+        """
+        Mutation of packed genomes: for each locus the number of mutants is drawn from a binomial distribution,
+        then their alleles are flipped all at once
+
+        :param genome: genomes to be mutated, modified in place
+        :type genome: np.ndarray of np.uint64
+        """
+        n = len(genome)
+        for k, count in enumerate(self.rng.binomial(n, self.mr)):
+            if count:
+                np.bitwise_xor.at(genome, self.rng.choice(n, count, replace=False), np.uint64(1) << np.uint64(k))
+
+    def reproduce(self, max_child=4):
+        """
+        Function to generate the new population from the parent individuals
+        1. Shuffle the current population and generate pairs of individuals
+        2. Draw the number of children of each pair and define their inherited genome (recombination and
+           mutation applied)
+        3. Replace the "old" array with the new generation, with an odd population the unpaired individual
+           survives and stays in front of the new generation
+        """
+        # 1
+        order = self.rng.permutation(len(self.genome))
+        half = len(order) // 2
+        agent1 = order[0:2 * half:2]
+        agent2 = order[1:2 * half:2]
+
+        # 2
+        n_child = self.rng.integers(2, max_child + 1, size=half)
+        genome = self.recombine(self.genome[np.repeat(agent1, n_child)], self.genome[np.repeat(agent2, n_child)])
+        self.mutate(genome)
+
+        # 3
+        self.genome = np.concatenate([self.genome[order[2 * half:]], genome])
+
+    def step(self) -> None:
+        """
+        Model step, see BeardModelAdv.step: each agent is randomly assigned to an "interaction room", only the first
+        two agents entering a dangerous room are considered. All the rooms are resolved at the same time:
+        - an agent alone in the room dies
+        - if the first agent is altruist and the second has the green beard the first one dies with probability dr,
+          otherwise the second one dies
+        """
+
+        # creating the "interaction rooms"
+        num_agents = len(self.genome)
+        if not self.linkage_dis:
+            danger_number = num_agents // 1.893
+        else:
+            danger_number = num_agents // 1.9
+
+        # assign each agent to an "interaction room", only the rooms with number lower than danger_number
+        # are dangerous
+        room = self.rng.integers(1, num_agents + 1, size=num_agents)
+        in_danger = np.flatnonzero(room < danger_number)
+
+        # agents enter the rooms in the order of the population, the stable sort keeps that order within rooms
+        in_danger = in_danger[np.argsort(room[in_danger], kind="stable")]
+        sorted_room = room[in_danger]
+        first = np.ones(len(in_danger), dtype=bool)
+        first[1:] = sorted_room[1:] != sorted_room[:-1]
+        second = np.zeros(len(in_danger), dtype=bool)
+        second[1:] = first[:-1] & ~first[1:]
+
+        # capacity-2 rule: agents after the second one of a room are ignored
+        alone = first & ~np.append(second[1:], False)
+        agent1 = in_danger[first & ~alone]
+        agent2 = in_danger[second]
+
+        # agents alone die; if the first agent is altruist and the second is bearded the first one dies with
+        # probability dr, otherwise the second one dies
+        altruism, beard = self.allele(ALTRUISM), self.allele(BEARD)
+        helps = altruism[agent1] & beard[agent2]
+        sacrifice = helps & (self.rng.random(len(agent1)) < self.dr)
+
+        alive = np.ones(num_agents, dtype=bool)
+        alive[in_danger[alone]] = False
+        alive[agent1[sacrifice]] = False
+        alive[agent2[~helps]] = False
+        self.genome = self.genome[alive]
+
+        self.schedule.step()
+
+        self.reproduce()
+        self.datacollector.collect(self)
+
+
+if __name__ == "__main__":
+    # altruism and green beard loci followed by 8 neutral loci, each one loosely linked to the previous
+    model = MultilocusBeardModel(N=2000, r=0.5, dr=0.95, mr=0.0001, recombination=[0.0] + [0.05] * 8,
+                                 linkage_dis=True)
+
+    for i in range(1000):
+        model.step()
+
+    print(model.datacollector.get_model_vars_dataframe().iloc[-1])
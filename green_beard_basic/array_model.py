@@ -0,0 +1,161 @@
+from mesa import Model
+from mesa.time import BaseScheduler
+from mesa.datacollection import DataCollector
+import numpy as np
+
+
+class ArrayBeardModel(Model):
+    """
+    Struct-of-arrays version of the BeardModel.
+    Individuals are not Mesa agents anymore but entries of a numpy array of genotypes, kept in the same order
+    the BeardModel schedule would have them. Interaction rooms, deaths and reproduction are resolved for the
+    whole population at once, so the model can be run with a population 100 times larger.
+    The life cycle and the parameters are the same of the BeardModel.
+
+    :param Model: the model class for Mesa framework
+    :type Model: mesa.model
+    """
+
+    def __init__(self, N=1000, r=0.5, dr=0.95, mr=0.001):
+        """
+        Struct-of-arrays version of the BeardModel.
+
+        :param N: total number of agents, defaults to 1000
+        :type N: int, optional
+        :param r: initial ratio of altruistic allele, defaults to 0.5
+        :type r: float, optional
+        :param dr: death rate for sacrificing altruist, defaults to 0.95
+        :type dr: float, optional
+        :param mr: mutation rate, defaults to 0.001
+        :type mr: float, optional
+        """
+
+        super().__init__()
+        # the scheduler holds no agent, it is only used to keep track of the steps
+        self.schedule = BaseScheduler(self)
+        self.rng = np.random.default_rng(self._seed)
+        self.N = N
+        self.mr = mr
+        self.dr = dr
+
+        self.running = True
+        self.datacollector = DataCollector(model_reporters={"altruistic fraction": lambda x: x.genotype.mean(),
+                                                            "n_agents": lambda x: len(x.genotype)})
+
+        self.add_agents(N, r)
+        self.reproduce()
+
+    def add_agents(self, N, r):
+        """
+        Add agents to the model with the right proportion (r) of altruistic allele
+
+        :param N: total number of agents
+        :type N: int
+        :param r: initial ratio of altruistic allele
+        :type r: float
+        """
+        # altruist agents (genotype = 1) come first, then the non-altruist ones (genotype = 0)
+        self.genotype = np.zeros(N, dtype=np.int8)
+        self.genotype[:int(N * r)] = 1
+
+    def get_population(self):
+        """
+        Genotypes of the population, used to exchange migrants between demes
+
+        :return: genotype of each agent
+        :rtype: np.ndarray
+        """
+        return self.genotype
+
+    def set_population(self, genotype):
+        """
+        Replace the population, used to exchange migrants between demes
+
+        :param genotype: genotype of each agent
+        :type genotype: np.ndarray
+        """
+        self.genotype = np.asarray(genotype, dtype=np.int8)
+
+    def reproduce(self, max_child=4):
+        """
+        Function to generate the new population from the parent individuals
+        1. Shuffle the current population and generate pairs of individuals
+        2. Draw the number of children of each pair and define their inherited genotype (mutation applied)
+        3. Replace the "old" array with the new generation, with an odd population the unpaired individual
+           survives and stays in front of the new generation
+        """
+
+        # 1
+        order = self.rng.permutation(len(self.genotype))
+        half = len(order) // 2
+        agent1 = order[0:2 * half:2]
+        agent2 = order[1:2 * half:2]
+
+        # 2
+        n_child = self.rng.integers(2, max_child + 1, size=half)
+        p1 = np.repeat(agent1, n_child)
+        p2 = np.repeat(agent2, n_child)
+        genotype = np.where(self.rng.random(len(p1)) < 0.5, self.genotype[p1], self.genotype[p2])
+        mutate = self.rng.random(len(genotype)) < self.mr
+        genotype[mutate] = 1 - genotype[mutate]
+
+        # 3
+        self.genotype = np.concatenate([self.genotype[order[2 * half:]], genotype])
+
+    def step(self) -> None:
+        """
+        Model step, see BeardModel.step: each agent is randomly assigned to an "interaction room", only the first
+        two agents entering a dangerous room are considered. All the rooms are resolved at the same time:
+        - an agent alone in the room dies
+        - if both agents are altruist the first one dies with probability dr, otherwise the first one dies
+        """
+
+        # creating the "interaction rooms"
+        num_agents = len(self.genotype)
+        danger_number = num_agents // 1.8
+
+        # assign each agent to an "interaction room", only the rooms with number lower than danger_number
+        # are dangerous
+        room = self.rng.integers(1, num_agents + 1, size=num_agents)
+        in_danger = np.flatnonzero(room < danger_number)
+
+        # agents enter the rooms in the order of the population, the stable sort keeps that order within rooms
+        in_danger = in_danger[np.argsort(room[in_danger], kind="stable")]
+        sorted_room = room[in_danger]
+        first = np.ones(len(in_danger), dtype=bool)
+        first[1:] = sorted_room[1:] != sorted_room[:-1]
+        second = np.zeros(len(in_danger), dtype=bool)
+        second[1:] = first[:-1] & ~first[1:]
+
+        # capacity-2 rule: agents after the second one of a room are ignored
+        occupants = np.minimum(np.bincount(sorted_room, minlength=num_agents + 1), 2)
+        agent1 = in_danger[first]
+        alone = occupants[sorted_room[first]] == 1
+        agent2 = in_danger[second]
+
+        # agents alone die, the first agent of a pair dies unless both are altruist and it survives with
+        # probability 1 - dr
+        paired = agent1[~alone]
+        both_altruist = (self.genotype[paired] == 1) & (self.genotype[agent2] == 1)
+        survive = both_altruist & (self.rng.random(len(paired)) >= self.dr)
+
+        alive = np.ones(num_agents, dtype=bool)
+        alive[agent1[alone]] = False
+        alive[paired[~survive]] = False
+        self.genotype = self.genotype[alive]
+
+        self.schedule.step()
+
+        self.reproduce()
+        self.datacollector.collect(self)
+
+
+if __name__ == "__main__":
+
+    model = ArrayBeardModel(N=100000)
+    print("Initial frequency of green beard allele:", model.genotype.mean())
+
+    for i in range(1000):
+        model.step()
+
+    print("Final frequency of green beard allele:", model.genotype.mean())
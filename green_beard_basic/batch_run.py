@@ -1,6 +1,9 @@
+import os
+import sys
 from model import BeardModel
-from mesa.batchrunner import batch_run
-import pandas as pd
+# the batch runner is shared by all the scenarios and lives in the root of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from batch_stream import stream_batch_run
 
 if __name__ == '__main__':
     params = {"N": 1000,
@@ -9,18 +12,16 @@ if __name__ == '__main__':
               "mr": 0.001}  #[0.001 * x for x in range(1, 2)]}
 
 
-    results = batch_run(
+    stream_batch_run(
         BeardModel,
         parameters=params,
+        path="result.csv",
         iterations=20,
         max_steps=1000,
         number_processes=None,
         data_collection_period=1,
         display_progress=True,
+        # True to complete an interrupted run of the same sweep instead of overwriting the output
+        resume=False,
     )
-
-    results_df = pd.DataFrame(results)
-
-
-    results_df.to_csv("result.csv")
-    #results_df.to_csv("multi_result.csv")
+    # path="multi_result.csv" for the multi parameters runs
@@ -1,29 +1,13 @@
+import os
+import sys
 import random
 from mesa import Agent, Model
 from mesa.datacollection import DataCollector
-from mesa.time import BaseScheduler
 
-
-class SocialActivation(BaseScheduler):
-    """
-    A scheduler which activates each agent once per step, in random order,
-    with the order reshuffled every step but only activate the actors.
-
-    :param BaseScheduler: activates agents one at a time, in the order they were added.
-    Assumes that each agent added has a step method which takes no arguments.
-    """
-
-    def step(self, actors) -> None:
-        """
-        Executes the step of all agents, one at a time, in
-        random order.
-        """
-
-        for agent in self.agent_buffer(shuffled=True):
-            if agent.unique_id in actors:
-                agent.step()
-        self.steps += 1
-        self.time += 1
+# the scheduler is shared by all the scenarios and lives in the root of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from social_activation import SocialActivation
+from convergence import ConvergenceMonitor
 
 
 class BeardAgent(Agent):
@@ -58,7 +42,7 @@ class BeardModel(Model):
     :type Model: mesa.model
     """
 
-    def __init__(self, N=1000, r=0.5, dr=0.95, mr=0.001):
+    def __init__(self, N=1000, r=0.5, dr=0.95, mr=0.001, stop_window=0, stop_tol=0.01, debug=False):
         """
         BeardModel init function
 
@@ -70,18 +54,31 @@ class BeardModel(Model):
         :type dr: float, optional
         :param mr: mutation rate, defaults to 0.001
         :type mr: float, optional
+        :param stop_window: number of steps of the rolling window used to detect a steady state and stop the run
+        early, 0 to always run until max_steps, defaults to 0
+        :type stop_window: int, optional
+        :param stop_tol: maximum variation of the monitored fractions within the window, defaults to 0.01
+        :type stop_tol: float, optional
+        :param debug: cross-check the counters of the scheduler against a full scan of the agents at every
+        reading, defaults to False
+        :type debug: bool, optional
         """
 
-        self.schedule = SocialActivation(self)
+        # the scheduler counts the agents carrying each allele
+        self.schedule = SocialActivation(self, key=lambda a: a.genotype, debug=debug)
         self.N = N
         self.current_id = 0
         self.mr = mr
         self.dr = dr
 
         self.running = True
-        self.datacollector = DataCollector(model_reporters={"altruistic fraction": lambda x: len(
-            [a for a in x.schedule.agent_buffer() if a.genotype == 1]) / x.schedule.get_agent_count(),
-                "n_agents": lambda x: x.schedule.get_agent_count()})
+        # without mutation the fixation and the loss of the green beard allele are absorbing states
+        self.monitor = ConvergenceMonitor(stop_window, stop_tol, absorbing=(0.0, 1.0) if mr == 0 else ()) \
+            if stop_window else None
+        self.stop_step = None
+        self.datacollector = DataCollector(model_reporters={
+            "altruistic fraction": lambda x: x.schedule.class_count(1) / x.schedule.get_agent_count(),
+            "n_agents": lambda x: x.schedule.get_agent_count()})
 
         self.add_agents(N, r)
         self.reproduce()
@@ -106,17 +103,37 @@ class BeardModel(Model):
             agent = BeardAgent(self.next_id(), self, 0)
             self.schedule.add(agent)
 
+    def get_population(self):
+        """
+        Genotypes of the agents in the schedule, used to exchange migrants between demes
+
+        :return: genotype of each agent
+        :rtype: list
+        """
+        return [a.genotype for a in self.schedule.agent_buffer()]
+
+    def set_population(self, genotypes):
+        """
+        Replace the agents in the schedule with new agents with the given genotypes, used to exchange
+        migrants between demes
+
+        :param genotypes: genotype of each agent
+        :type genotypes: list
+        """
+        self.schedule.swap_generation([BeardAgent(self.next_id(), self, int(g)) for g in genotypes])
+
     def reproduce(self, max_child=4):
         """
         Function to generate the new population from the parent individuals
         1. Sample individuals from current population and Generate pairs of individuals
         2. Create the new generation within a range, defining inherited genotype (mutation applied)
-        3. Add the new generation of agents to the model
-        4. Remove all the "old" agents from the model
+        3. Replace the "old" agents with the new generation in the model, with an odd population the unpaired
+           agent survives
         """
 
         # 1
         agents = random.sample([agent for agent in self.schedule.agents], k=len(self.schedule.agents))
+        newgen = agents[len(agents) // 2 * 2:]
 
         for i in range(0, len(agents)-1, 2):
             agent1 = agents[i]
@@ -129,14 +146,10 @@ class BeardModel(Model):
                 mutate = lambda x: x if random.random() > self.mr else 1 - x
                 # 0. is 1-mutation rate: 1-0.03 = 0.97 in accordance to bio findings
                 child_genotype = mutate(child_genotype)
-                child = BeardAgent(self.next_id(), self, child_genotype)
-
-                # 3
-                self.schedule.add(child)
+                newgen.append(BeardAgent(self.next_id(), self, child_genotype))
 
-            # 4
-            self.schedule.remove(agent1)
-            self.schedule.remove(agent2)
+        # 3
+        self.schedule.swap_generation(newgen)
 
     def step(self) -> None:
         """
@@ -203,6 +216,8 @@ class BeardModel(Model):
 
         self.reproduce()
         self.datacollector.collect(self)
+        if self.monitor is not None:
+            self.monitor.update(self)
 
 
 if __name__ == "__main__":
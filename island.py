@@ -0,0 +1,316 @@
+import os
+import sys
+import random
+import importlib.util
+from contextlib import contextmanager
+from multiprocessing import Pipe, Process
+
+import numpy as np
+import pandas as pd
+from mesa import Model
+from mesa.time import BaseScheduler
+from mesa.datacollection import DataCollector
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_engine(spec):
+    """
+    Load a model class from a "path/to/file.py:Class" specification, relative paths start from the root of the
+    repository. The folder of the file is added to the path, so that the model can import its own modules
+
+    :param spec: path of the file and name of the class, separated by a colon
+    :type spec: str
+    :return: the model class
+    :rtype: Type[Model]
+    """
+    path, name = spec.rsplit(":", 1)
+    path = os.path.join(ROOT, path)
+    folder = os.path.dirname(path)
+    if folder not in sys.path:
+        sys.path.insert(0, folder)
+    module_spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0], path)
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+    return getattr(module, name)
+
+
+class Deme:
+    """
+    A deme of the island model: an instance of a model exposing get_population and set_population, the list or
+    array of the genotypes of its agents, plus the operations needed to exchange migrants with the other demes.
+    The agent based models draw from the global generators (random and np.random), each deme keeps its own state
+    of them and swaps it in while its model runs, so a deme gives the same results in a worker process and
+    in the process of the IslandModel together with the other demes
+    """
+
+    def __init__(self, index, spec, kwargs, seed):
+        """
+        :param index: index of the deme
+        :type index: int
+        :param spec: model class specification, see load_engine
+        :type spec: str
+        :param kwargs: parameters of the model
+        :type kwargs: dict
+        :param seed: seed of the generators of the deme
+        :type seed: np.random.SeedSequence
+        """
+        self.index = index
+        state = seed.generate_state(3)
+        self.random_state = random.Random(int(state[0])).getstate()
+        self.np_random_state = np.random.RandomState(int(state[1])).get_state()
+        # the model is seeded as Model(seed=...) would do, but the seed is not passed to the model __init__;
+        # mesa keeps the generator of the model in the class, shared by all the demes of the process, so each
+        # model gets its own one
+        cls = load_engine(spec)
+        self.model = cls.__new__(cls, seed=int(state[2]))
+        self.model.random = random.Random(int(state[2]))
+        with self.generators():
+            self.model.__init__(**kwargs)
+        # generator used to pick the migrants
+        self.rng = np.random.default_rng(seed)
+        self.residents = None
+
+    @contextmanager
+    def generators(self):
+        """
+        Context in which the global generators are in the state of this deme, their previous state is restored
+        on exit
+        """
+        outer = random.getstate(), np.random.get_state()
+        random.setstate(self.random_state)
+        np.random.set_state(self.np_random_state)
+        try:
+            yield
+        finally:
+            self.random_state = random.getstate()
+            self.np_random_state = np.random.get_state()
+            random.setstate(outer[0])
+            np.random.set_state(outer[1])
+
+    def step(self):
+        """
+        Advance the model by one generation
+
+        :return: model variables collected at the end of the step
+        :rtype: dict
+        """
+        with self.generators():
+            self.model.step()
+        return {name: values[-1] for name, values in self.model.datacollector.model_vars.items()}
+
+    def emigrate(self, rates):
+        """
+        Pick the migrants: each agent moves to deme j with probability rates[j], the entry of this deme is the
+        probability to stay. The agents staying keep their order
+
+        :param rates: row of the migration matrix of this deme
+        :type rates: np.ndarray
+        :return: genotypes of the migrants to each deme, empty for this deme
+        :rtype: list of np.ndarray
+        """
+        population = np.asarray(self.model.get_population())
+        counts = self.rng.multinomial(len(population), rates)
+        groups = np.split(self.rng.permutation(len(population)), np.cumsum(counts)[:-1])
+        self.residents = population[np.sort(groups[self.index])]
+        groups[self.index] = groups[self.index][:0]
+        return [population[group] for group in groups]
+
+    def immigrate(self, migrants):
+        """
+        Replace the population with the agents which did not leave the deme followed by the incoming migrants
+
+        :param migrants: genotypes of the incoming migrants from each deme
+        :type migrants: list of np.ndarray
+        """
+        with self.generators():
+            self.model.set_population(np.concatenate([self.residents] + migrants))
+        self.residents = None
+
+
+def _deme_worker(conn, index, spec, kwargs, seed):
+    """
+    Worker process hosting a deme: executes the methods of the deme requested through the pipe and sends back
+    their results, until None is received
+
+    :param conn: end of the pipe connected to the IslandModel
+    :type conn: multiprocessing.connection.Connection
+    """
+    deme = Deme(index, spec, kwargs, seed)
+    while True:
+        request = conn.recv()
+        if request is None:
+            conn.close()
+            return
+        method, args = request
+        try:
+            conn.send(getattr(deme, method)(*args))
+        except Exception as e:
+            conn.send(e)
+
+
+class IslandModel(Model):
+    """
+    Metapopulation of D demes, each one an independent instance of a green beard model (any model exposing
+    get_population and set_population), exchanging migrants every period generations according to a
+    migration matrix.
+    With parallel set, each deme lives in its own worker process and only the genotypes of the migrants go through
+    the pipes, so the total population scales with the number of cores. Worker processes cannot be started from
+    the processes of a Pool, so in a batch run either run a single process or set parallel to False.
+
+    The collected variables are the ones of the demes: n_agents is summed over the demes, all the other
+    variables are averaged weighting each deme by its number of agents. The variables of each deme are kept
+    in deme_data.
+
+    :param Model: the model class for Mesa framework
+    :type Model: mesa.model
+    """
+
+    def __init__(self, engine="green_beard_basic/array_model.py:ArrayBeardModel", demes=4, migration=0.01,
+                 period=1, parallel=True, **kwargs):
+        """
+        Metapopulation of D demes exchanging migrants
+
+        :param engine: model of the demes as "path/to/file.py:Class", relative to the root of the repository,
+        defaults to "green_beard_basic/array_model.py:ArrayBeardModel"
+        :type engine: str, optional
+        :param demes: number of demes, defaults to 4
+        :type demes: int, optional
+        :param migration: migration matrix, entry (i, j) is the probability for an agent of deme i to move to deme j;
+        a single value m is the island model with probability m to leave the deme to any other deme, defaults to 0.01
+        :type migration: float or np.ndarray, optional
+        :param period: number of generations between two migrations, defaults to 1
+        :type period: int, optional
+        :param parallel: run each deme in its own process, defaults to True
+        :type parallel: bool, optional
+        :param kwargs: parameters of the model of each deme (e.g. N, r, dr, mr)
+        """
+
+        super().__init__()
+        # the seed is consumed by mesa (Model.__new__), it is not a parameter of the demes
+        kwargs.pop("seed", None)
+        self.schedule = BaseScheduler(self)
+        self.demes = demes
+        self.period = period
+        if np.ndim(migration) == 0:
+            self.migration = np.full((demes, demes), migration / max(demes - 1, 1))
+            np.fill_diagonal(self.migration, 1 - migration)
+        else:
+            self.migration = np.asarray(migration, dtype=float)
+        self.migration = self.migration / self.migration.sum(axis=1, keepdims=True)
+
+        seeds = np.random.SeedSequence(self._seed).spawn(demes)
+        self.parallel = parallel
+        self.closed = False
+        if parallel:
+            self.pipes, self.workers = [], []
+            for d in range(demes):
+                conn, worker_conn = Pipe()
+                worker = Process(target=_deme_worker, args=(worker_conn, d, engine, kwargs, seeds[d]), daemon=True)
+                worker.start()
+                self.pipes.append(conn)
+                self.workers.append(worker)
+        else:
+            self.deme_models = [Deme(d, engine, kwargs, seeds[d]) for d in range(demes)]
+
+        # variables collected by each deme at each step
+        self.deme_data = []
+        self.running = True
+        self.datacollector = None
+
+    def _call(self, method, args):
+        """
+        Call a method of all the demes, the demes run in parallel if they live in worker processes
+
+        :param method: name of the method of the Deme
+        :type method: str
+        :param args: arguments of the call for each deme
+        :type args: list of tuple
+        :return: result of each deme
+        :rtype: list
+        """
+        if self.closed:
+            raise RuntimeError("the demes of the IslandModel have been closed")
+        if not self.parallel:
+            return [getattr(deme, method)(*a) for deme, a in zip(self.deme_models, args)]
+        for conn, a in zip(self.pipes, args):
+            conn.send((method, a))
+        results = [conn.recv() for conn in self.pipes]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def aggregate(self, name):
+        """
+        Variable of the whole metapopulation at the last step
+
+        :param name: name of the variable collected by the demes
+        :type name: str
+        :return: sum of n_agents, otherwise mean weighted by the number of agents of each deme
+        :rtype: float
+        """
+        data = self.deme_data[-1]
+        values = np.array([d[name] for d in data], dtype=float)
+        if name == "n_agents":
+            return values.sum()
+        if "n_agents" not in data[0]:
+            return np.nanmean(values)
+        weights = np.array([d["n_agents"] for d in data], dtype=float)
+        valid = weights > 0
+        return np.average(values[valid], weights=weights[valid]) if valid.any() else float("nan")
+
+    def migrate(self):
+        """
+        Exchange of the migrants: each deme picks its migrants, then the migrants are delivered to the
+        destination demes
+        """
+        outgoing = self._call("emigrate", [(self.migration[d],) for d in range(self.demes)])
+        self._call("immigrate", [([outgoing[i][d] for i in range(self.demes)],) for d in range(self.demes)])
+
+    def step(self) -> None:
+        """
+        Model step: all the demes advance by one generation and their data are collected, then every period
+        generations the migrants are exchanged
+        """
+        data = self._call("step", [()] * self.demes)
+        self.schedule.step()
+        if self.schedule.steps % self.period == 0:
+            self.migrate()
+
+        self.deme_data.append(data)
+        if self.datacollector is None:
+            # the collected variables are the ones of the demes, known after the first step
+            self.datacollector = DataCollector(model_reporters={
+                name: (lambda x, name=name: x.aggregate(name)) for name in data[0]})
+        self.datacollector.collect(self)
+
+    def get_deme_dataframe(self):
+        """
+        Variables collected by each deme
+
+        :return: one row for each step and deme
+        :rtype: pd.DataFrame
+        """
+        return pd.DataFrame([{"Step": step, "deme": d, **row} for step, data in enumerate(self.deme_data)
+                             for d, row in enumerate(data)])
+
+    def close(self):
+        """
+        Stop the worker processes of the demes, the model cannot be stepped anymore
+        """
+        if self.parallel and not self.closed:
+            for conn in self.pipes:
+                conn.send(None)
+            for worker in self.workers:
+                worker.join()
+        self.closed = True
+
+
+if __name__ == "__main__":
+    model = IslandModel(engine="green_beard_basic/array_model.py:ArrayBeardModel", demes=8, migration=0.01,
+                        period=5, N=100000, r=0.5, dr=0.95, mr=0.001)
+    for i in range(100):
+        model.step()
+    model.close()
+    print(model.datacollector.get_model_vars_dataframe().tail())
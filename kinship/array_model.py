@@ -0,0 +1,129 @@
+from mesa import Model
+from mesa.time import BaseScheduler
+from mesa.datacollection import DataCollector
+import numpy as np
+
+
+class ArrayFamilyModel(Model):
+    """
+    Struct-of-arrays version of the FamilyModel.
+    Individuals are not Mesa agents anymore but rows of numpy arrays (genotype and family id), in this way
+    danger rooms, actors, altruistic actions and reproduction are resolved for the whole population at once
+    and the model can be run with millions of agents.
+    The life cycle and the parameters are the same of the FamilyModel.
+
+    :param Model: the model class for Mesa framework
+    :type Model: mesa.model
+    """
+
+    def __init__(self, N=500, r=0.5, dr=0.95, mr=0.001):
+        """
+        Struct-of-arrays version of the FamilyModel.
+
+        :param N: total number of agents, defaults to 500
+        :type N: int, optional
+        :param r: initial ratio of altruistic allele, defaults to 0.5
+        :type r: float, optional
+        :param dr: death rate for sacrificing altruist, defaults to 0.95
+        :type dr: float, optional
+        :param mr: mutation rate, defaults to 0.001
+        :type mr: float, optional
+        """
+
+        super().__init__()
+        # the scheduler holds no agent, it is only used to keep track of the steps
+        self.schedule = BaseScheduler(self)
+        self.rng = np.random.default_rng(self._seed)
+        self.N = N
+        self.mr = mr
+        self.dr = dr
+        self.running = True
+        self.datacollector = DataCollector(model_reporters={"altruistic fraction": lambda x: x.genotype.mean()})
+
+        self.add_agents(N, r)
+
+        self.reproduce()
+
+    def add_agents(self, N, r):
+        """
+        Add agents to the model with the right proportion (r) of altruistic allele.
+        Each founder is the only member of its own family
+
+        :param N: total number of agents
+        :type N: int
+        :param r: initial ratio of altruistic allele
+        :type r: float
+        """
+        # altruist agents (genotype = 1) come first, then the non-altruist ones (genotype = 0)
+        self.genotype = np.zeros(N, dtype=np.int8)
+        self.genotype[:int(N * r)] = 1
+        self.family = np.arange(N)
+        self.alive = np.ones(N, dtype=bool)
+
+    def reproduce(self):
+        """
+        Function to generate the new population from the surviving individuals
+        1. Sample N individuals from current population
+        2. Generate pairs of individuals
+        3. Create the new generation, defining inherited genotype (mutation applied) and family ID
+        4. Replace the "old" arrays with the new generation
+        """
+        # 1
+        mating_ind = self.rng.choice(np.flatnonzero(self.alive), self.N, replace=False)
+        # 2
+        half = len(mating_ind) // 2
+        p1 = np.repeat(mating_ind[:half], 3)
+        p2 = np.repeat(mating_ind[half:2 * half], 3)
+        # 3
+        genotype = np.where(self.rng.random(len(p1)) < 0.5, self.genotype[p1], self.genotype[p2])
+        mutate = self.rng.random(len(genotype)) < self.mr
+        genotype[mutate] = 1 - genotype[mutate]
+        # 4
+        self.genotype = genotype
+        self.family = np.repeat(np.arange(half), 3)
+        self.alive = np.ones(len(genotype), dtype=bool)
+
+    def step(self) -> None:
+        """
+        Model step: each family is randomly assigned to an "interaction room", only the dangerous ones are
+        computed (see FamilyModel.step). All the rooms are resolved at the same time:
+        - altruist actors die with probability dr, the rest of the family survives
+        - non-altruist actors survive and the rest of their family dies
+        """
+
+        # family ids are contiguous so the members of each family are a slice of the arrays
+        sizes = np.bincount(self.family)
+        starts = np.cumsum(sizes) - sizes
+
+        # we just deal with families in dangerous scenario to save computations
+        danger_fam = self.rng.choice(len(sizes), self.N // 4, replace=False)
+
+        # defining the actor randomly
+        active = starts[danger_fam] + (self.rng.random(len(danger_fam)) * sizes[danger_fam]).astype(int)
+        altruist = self.genotype[active] == 1
+
+        # perform altruistic action
+        # 1 - death rate (dr) gives the probability for the altruistic agent to survive
+        sacrificed = active[altruist & (self.rng.random(len(active)) <= self.dr)]
+        self.alive[sacrificed] = False
+
+        # non-altruist actors sacrifice the rest of the family
+        coward_fam = np.zeros(len(sizes), dtype=bool)
+        coward_fam[danger_fam[~altruist]] = True
+        killed = coward_fam[self.family]
+        killed[active[~altruist]] = False
+        self.alive[killed] = False
+
+        self.schedule.step()
+
+        self.reproduce()
+
+        self.datacollector.collect(self)
+
+
+if __name__ == "__main__":
+    model = ArrayFamilyModel(N=10 ** 6, mr=0.001, r=0.5)
+    print("\naltruists before steps\t", model.genotype.mean())
+    for i in range(500):
+        model.step()
+    print("\naltruists after steps\t", model.genotype.mean())
@@ -1,8 +1,11 @@
+import os
+import sys
 from multigene_model import MultigeneFamilyModel
 from ibd_model import IBDFamilyModel
 from model import FamilyModel
-from mesa.batchrunner import batch_run
-import pandas as pd
+# the batch runner is shared by all the scenarios and lives in the root of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from batch_stream import stream_batch_run, read_results
 
 if __name__ == '__main__':
     params = {"N": 30, #range(140, 220, 20),
@@ -11,17 +14,19 @@ if __name__ == '__main__':
               "mr": 0.001 #[0.001 * x for x in range(1,4)] #0.001
               }
 
-    results = batch_run(
-    IBDFamilyModel,
+    stream_batch_run(
+        IBDFamilyModel,
         parameters=params,
+        path="./final_data/ibd_result.csv",
         iterations=30,
         max_steps=500,
         number_processes=None,
         data_collection_period=1,
         display_progress=True,
+        # True to complete an interrupted run of the same sweep instead of overwriting the output
+        resume=False,
     )
     
-    results_df = pd.DataFrame(results)
+    results_df = read_results("./final_data/ibd_result.csv")
     print(results_df)
-    results_df.to_csv("./final_data/ibd_result.csv")
 
@@ -1,8 +1,7 @@
 import pandas
 import random
 from model import *
-import networkx as nx
-from utils import IBDFamilyTree
+from utils import Pedigree, KinshipMatrix
 
 class IBDFamilyAgent(FamilyAgent):
     """
@@ -16,47 +15,22 @@ class IBDFamilyAgent(FamilyAgent):
 
     def altruistic_action(self):
         """
-        Implementation of a generic altruistic action. 
-        If the actor is altruist he can sacrifice or not. The choice is based on the benefit 
-        gained by performing the altruistic. The more the recipient is related to the actor
-        the higher the benefit. 
-        The Actor has to calculate the Benefit = Sum_i(P_ibd(A, R_i)
-        A = actor, R_i = ith recipient
+        The altruistic actions of all the actors are resolved by IBDFamilyModel.resolve_rooms in a single
+        batched pass during the model step, activating a single agent would resolve its room a second time
         """
-
-        A_index = self.model.active.index(self.unique_id)
-        A_room = self.model.rooms[A_index]
-
-        pre = str(self.model.schedule.steps) + "#"
-
-        if self.genotype:
-            # computing the benefit
-            A_room.remove(self)
-            b = sum([1 * self.model.tree.ig_ibd_coeff(pre + str(self.unique_id),
-                    pre + str(a.unique_id)) for a in A_room])
-
-            if b > 1:
-                #print("alt done")
-                if random.random() > self.model.dr:
-                    return
-                else:
-                    self.model.schedule.remove(self)
-            else:
-                [self.model.schedule.remove(a) for a in A_room if a.unique_id != self.unique_id]
-
-        else:
-            [self.model.schedule.remove(a) for a in A_room if a.unique_id != self.unique_id]
+        raise RuntimeError("IBDFamilyAgent actions are resolved by IBDFamilyModel.resolve_rooms")
 
 class IBDFamilyModel(FamilyModel):
     """
     Extension of the FamilyModel in order to deal with different setting in the interaction rooms.
-    Genealogy of the agents in the simulation is represented as a tree DAG. The DAG stores 3 generations only
+    Genealogy of the agents in the simulation is stored as a pedigree of a fixed number of generations only,
+    by default 3: current generation, parents and grandparents
 
     :param FamilyModel: A model for simulation of the evolution of families. 
     :type FamilyModel: FamilyModel
     """
 
-    def __init__(self, N=500, r=0.5, dr=0.9, mr=0.001):
+    def __init__(self, N=500, r=0.5, dr=0.9, mr=0.001, depth=3, stop_window=0, stop_tol=0.01, debug=False):
         """
         Extension of the FamilyModel in order to deal with different setting in the interaction rooms.
 
@@ -68,14 +42,25 @@ class IBDFamilyModel(FamilyModel):
         :type dr: float, optional
         :param mr: mutation rate, defaults to 0.001
         :type mr: float, optional
+        :param depth: number of generations in the genealogy, current one included, defaults to 3
+        :type depth: int, optional
+        :param stop_window: number of steps of the rolling window used to detect a steady state and stop the run
+        early, 0 to always run until max_steps, defaults to 0
+        :type stop_window: int, optional
+        :param stop_tol: maximum variation of the monitored fractions within the window, defaults to 0.01
+        :type stop_tol: float, optional
+        :param debug: cross-check the counters of the scheduler against a full scan of the agents at every
+        reading, defaults to False
+        :type debug: bool, optional
         """
-        self.tree = IBDFamilyTree(nx.DiGraph(), self)
-        super().__init__(N=N, r=r, dr=dr, mr=mr)
-
-        self.datacollector = DataCollector(model_reporters={
-            "altruistic fraction": lambda x: len(
-                [a for a in x.schedule.agent_buffer() if a.genotype == 1]) / x.schedule.get_agent_count(),
-        })
+        # agents unique_id is their index in the generation, relatedness of the current generation is kept up
+        # to date from the parents of each new generation
+        self.depth = depth
+        self.kinship = KinshipMatrix(N, depth=depth - 1)
+        # with debug the parents of the last depth - 1 generations are also stored in a pedigree, to cross-check
+        # the relatedness against the nearest common ancestors
+        self.pedigree = Pedigree(N, depth=depth - 1) if debug else None
+        super().__init__(N=N, r=r, dr=dr, mr=mr, stop_window=stop_window, stop_tol=stop_tol, debug=debug)
 
     def add_agents(self, N, r):
         """
@@ -86,6 +71,10 @@ class IBDFamilyModel(FamilyModel):
         :param r: initial ratio of altruistic allele
         :type r: float
         """
+        # genotypes are also stored in an array indexed by unique_id to resolve the rooms in a batch
+        self.genotype = np.zeros(N, dtype=np.int8)
+        self.genotype[:int(N * r)] = 1
+
         # adding altruist agents (genotype = 1)
         for i in range(int(N * r)):
             agent = IBDFamilyAgent(i, self, 1, i)
@@ -102,9 +91,8 @@ class IBDFamilyModel(FamilyModel):
         1. Sample N individuals from current population
         2. Generate pairs of inidividuals
         3. Create the new generation, defining inherited genotype (mutation applied), family ID and parents ID
-        4. Remove oldest generation from the DAG
-        5. Remove all the "old" agents from the model
-        6. Add the new generation of agents to the model and the DAG
+        4. Replace the "old" agents with the new generation in the model and update the relatedness
+           (and the pedigree, dropping the oldest generation, with debug)
         """
         # 1
         mating_ind = random.sample([agent for agent in self.schedule.agents], k=self.N)
@@ -117,38 +105,91 @@ class IBDFamilyModel(FamilyModel):
         newgen = [{"genotype": mutate(random.choice([a.genotype for a in p])), 
                    "family": p[0].unique_id,
                    "parents id": [pa.unique_id for pa in p]} for p in mating_pairs for i in range(20)]
-    
-        # 4 
-        self.tree.remove_generation(self.schedule.steps - 3)
-        
-        # 5
-        [self.schedule.remove((a)) for a in self.schedule.agent_buffer()]
-        
-        # 6
-        for i in range(len(newgen)):
-            self.schedule.add(IBDFamilyAgent(
-                i, self, newgen[i]["genotype"], newgen[i]["family"]))
-            self.tree.add_child(newgen[i], i)
-        
-        self.tree.update_ig()
+
+        # 4
+        self.schedule.swap_generation([IBDFamilyAgent(i, self, newgen[i]["genotype"], newgen[i]["family"])
+                                       for i in range(len(newgen))])
+        self.genotype = np.array([c["genotype"] for c in newgen], dtype=np.int8)
+        parents = [c["parents id"] for c in newgen]
+        self.kinship.add_generation(parents)
+        if self.pedigree is not None:
+            self.pedigree.add_generation(parents)
+            self.check_kinship()
+
+    def check_kinship(self):
+        """
+        Cross-check the relatedness between the families of the current generation against their nearest common
+        ancestor in the pedigree (Pedigree.ibd_coeff)
+        """
+        # one individual for each family of the pedigree, in the order of the families
+        _, members = np.unique(self.pedigree.family, return_index=True)
+        expected = np.zeros((len(members), len(members)))
+        # the nearest common ancestor is the last one written
+        for back, sets in reversed(list(enumerate(self.pedigree.ancestor_sets))):
+            for f in range(len(sets)):
+                expected[f, np.bitwise_and(sets[f], sets).any(axis=1)] = 0.5 ** (back + 1)
+        family = self.kinship.family[members]
+        R = self.kinship.R[np.ix_(family, family)]
+        if not np.array_equal(R, expected):
+            f, g = np.argwhere(R != expected)[0]
+            raise Exception(f"Relatedness {R[f, g]} between agents {members[f]} and {members[g]} does not match "
+                            f"their nearest common ancestor in the pedigree ({expected[f, g]})")
+
+    def resolve_rooms(self, rooms):
+        """
+        Resolving the altruistic action of the actors of a batch of interaction rooms.
+        If the actor is altruist he can sacrifice or not. The choice is based on the benefit
+        gained by performing the altruistic. The more the recipient is related to the actor
+        the higher the benefit.
+        The Actor has to calculate the Benefit = Sum_i(P_ibd(A, R_i)
+        A = actor, R_i = ith recipient
+        If the actor sacrifices he dies with probability dr and the rest of the room survives, otherwise
+        he survives and the rest of the room dies.
+
+        :param rooms: indices of the rooms to be resolved
+        :type rooms: array-like of int
+        """
+        rooms = np.asarray(rooms)
+        members = self.rooms[rooms]
+        actors = self.active[rooms]
+
+        # computing the benefit, the relatedness of the actor with himself is removed from the sum
+        family = self.kinship.family
+        fa = family[actors]
+        b = self.kinship.R[fa[:, None], family[members]].sum(axis=1) - self.kinship.R[fa, fa]
+
+        sacrifice = (self.genotype[actors] == 1) & (b > 1)
+        # 1 - death rate (dr) gives the probability for the altruistic agent to survive
+        dead = [actors[sacrifice & (np.random.random(len(actors)) <= self.dr)]]
+        killed = members[~sacrifice]
+        dead.append(killed[killed != actors[~sacrifice][:, None]])
+
+        self.schedule.remove_many([self.schedule.get_agent(i) for i in np.concatenate(dead).tolist()])
 
     def step(self) -> None:
         """
         Model step: agents are randomly assigned to interaction rooms which are all dangerous. Depending
         on the selected actor an altruist action could be performed or not.
+        Rooms are stored as a (rooms x 30) array of unique ids, and all of them are resolved in one batched pass.
         """
-        
+        n = self.schedule.get_agent_count()
+
         # even in the worst case scenario at least N individuals survive so we can have all rooms as dangerous
-        self.rooms = np.random.choice(self.schedule.agents, (len(self.schedule.agents) // 40, 30), replace=False).tolist()
+        self.rooms = np.random.permutation(n)[:n // 40 * 30].reshape(n // 40, 30)
+
+        # defining the actor of each room randomly
+        self.active = self.rooms[np.arange(len(self.rooms)), np.random.randint(30, size=len(self.rooms))]
 
-        self.active = [random.choice(r).unique_id for r in self.rooms]
+        self.resolve_rooms(np.arange(len(self.rooms)))
 
-        self.schedule.step(self.active)
+        # the scheduler has no actor left to activate, it only advances the time
+        self.schedule.step([])
 
         self.reproduce()
         
         self.datacollector.collect(self)
-
+        if self.monitor is not None:
+            self.monitor.update(self)
 
 if __name__ == "__main__":
     model = IBDFamilyModel(N=30, mr=0.001, r=0.5)
@@ -0,0 +1,183 @@
+import random
+from statistics import NormalDist
+import numpy as np
+import pandas as pd
+
+
+def expected_dynamics(N=500, r=0.5, dr=0.95, mr=0.001, steps=500, variance=False):
+    """
+    Deterministic expected dynamics of the FamilyModel, computed following the same life cycle
+    on the frequencies instead of the individuals:
+    1. pairs of parents are sampled from the survivors, each family gets 3 offspring which inherit the
+       genotype of one random parent (mutation applied)
+    2. N//4 of the N//2 families meet danger, a random member of the family is the actor: an altruist dies with
+       probability dr and the family survives, a non-altruist survives and the rest of the family dies
+    The "altruistic fraction" is the expected fraction of the altruistic allele in the offspring, as collected
+    by the model after each step.
+
+    :param N: total number of agents, defaults to 500
+    :type N: int, optional
+    :param r: initial ratio of altruistic allele, defaults to 0.5
+    :type r: float, optional
+    :param dr: death rate for sacrificing altruist, defaults to 0.95
+    :type dr: float, optional
+    :param mr: mutation rate, defaults to 0.001
+    :type mr: float, optional
+    :param steps: number of model steps, defaults to 500
+    :type steps: int, optional
+    :param variance: compute also the variance across replicates, linear noise approximation of the
+    survival, of the sampling of the parents and of the inheritance, defaults to False
+    :type variance: bool, optional
+    :return: expected altruistic fraction at each step (and its variance)
+    :rtype: np.ndarray or tuple of np.ndarray
+    """
+    # fraction of the families meeting danger
+    h = (N // 4) / (N // 2)
+    k = np.arange(4)
+
+    def offspring(p):
+        # probability for an offspring to be altruist: genotype of a random parent, then mutation
+        return p * (1 - mr) + (1 - p) * mr
+
+    def families(p):
+        # distribution of the number of altruists in a family of 3, the parents pair can be made of
+        # two altruists, one altruist or no altruist
+        pairs = np.array([p ** 2, 2 * p * (1 - p), (1 - p) ** 2])
+        c = np.array([1 - mr, 0.5, mr])
+        binom = np.array([1, 3, 3, 1])
+        return pairs @ (binom * c[:, None] ** k * (1 - c[:, None]) ** (3 - k))
+
+    # outcomes of a family with k altruists: no danger, danger with an altruist actor who dies or survives,
+    # danger with a non-altruist actor; for each outcome probability, surviving altruists and survivors
+    outcomes = [(1 - h, k, 3 + 0 * k),
+                (h * (k / 3) * dr, k - 1, 2 + 0 * k),
+                (h * (k / 3) * (1 - dr), k, 3 + 0 * k),
+                (h * (3 - k) / 3, 0 * k, 1 + 0 * k)]
+
+    def survivors(p):
+        # expected fraction of altruists among the survivors
+        family = families(p)
+        alt = sum(prob * a for prob, a, _ in outcomes)
+        tot = sum(prob * n for prob, _, n in outcomes)
+        return (family @ alt) / (family @ tot)
+
+    def inheritance(s):
+        # variance of the genotype of an offspring given its parents: only the offspring of mixed pairs take
+        # the genotype of a random parent, the others are random only for the mutation
+        mixed = 2 * s * (1 - s)
+        return (mixed * 0.25 + (1 - mixed) * mr * (1 - mr)) / (3 * (N // 2))
+
+    def noise(s):
+        # variance added by one generation of the families born from parents with altruistic fraction s:
+        # which families survive the danger, sampling of the parents (without replacement among the survivors)
+        # and inheritance of the offspring
+        family = families(s)
+        ps = survivors(s)
+        tot = family @ sum(prob * n for prob, _, n in outcomes)
+        # the composition of the families is already fixed by the previous generation, only the outcome
+        # of the danger is random
+        deviation = sum(prob * (a - ps * n) for prob, a, n in outcomes)
+        spread = sum(prob * (a - ps * n - deviation) ** 2 for prob, a, n in outcomes)
+        survival = family @ spread / ((N // 2) * tot ** 2)
+        n_survivors = (N // 2) * tot
+        mating = ps * (1 - ps) / N * max(n_survivors - N, 0) / (n_survivors - 1)
+        return (1 - 2 * mr) ** 2 * (survival + mating) + inheritance(ps)
+
+    # the recursion follows the altruistic fraction of the parents (the survivors), mutation is applied by
+    # families when the offspring are born and by offspring only to report the collected value
+    # founders are not collected, the first value is the offspring of the first survivors
+    s = int(N * r) / N
+    # all the founders mate, the first generation varies only for the inheritance
+    var = inheritance(s)
+    trajectory, variances = [], []
+    for _ in range(steps):
+        if variance:
+            # linearized propagation of the variance of the previous generation plus the noise of this one;
+            # the offspring fraction is affine in the parents one, so the slope is the one of survivors
+            eps = 1e-6
+            sc = min(max(s, eps), 1 - eps)
+            slope = (survivors(sc + eps) - survivors(sc - eps)) / (2 * eps)
+            var = slope ** 2 * var + noise(s)
+        s = survivors(s)
+        trajectory.append(offspring(s))
+        variances.append(var)
+
+    if variance:
+        return np.array(trajectory), np.array(variances)
+    return np.array(trajectory)
+
+
+def validate(data, params=("N", "r", "dr", "mr")):
+    """
+    Compare the expected dynamics with the output of a batch run of the FamilyModel,
+    for each combination of parameters in the data
+
+    :param data: data obtained through the batch run
+    :type data: DataFrame
+    :param params: parameters of the model
+    :type params: tuple
+    :return: for each combination of parameters and step, mean of the runs, expected value and their difference
+    :rtype: DataFrame
+    """
+    results = []
+    for values, runs in data.groupby(list(params)):
+        kwargs = dict(zip(params, values))
+        abm = runs.groupby("Step")["altruistic fraction"].mean()
+        expected, var = expected_dynamics(steps=abm.index.max() + 1, variance=True, **kwargs)
+        result = pd.DataFrame({"Step": abm.index, "abm": abm.values, "expected": expected[abm.index],
+                               "sd": np.sqrt(var[abm.index])})
+        result["error"] = result["abm"] - result["expected"]
+        results.append(result.assign(**kwargs))
+    return pd.concat(results, ignore_index=True)
+
+
+def check(N=500, r=0.5, dr=0.95, mr=0.001, steps=100, runs=20, seed=0, alpha=0.01):
+    """
+    Regression check of the expected dynamics against the means of replicated runs of the FamilyModel:
+    at each step the mean of the runs must be within the two-sided normal quantile of alpha / steps
+    (Bonferroni correction for the tested steps) standard errors of the expected value
+
+    :param N: total number of agents, defaults to 500
+    :type N: int, optional
+    :param r: initial ratio of altruistic allele, defaults to 0.5
+    :type r: float, optional
+    :param dr: death rate for sacrificing altruist, defaults to 0.95
+    :type dr: float, optional
+    :param mr: mutation rate, defaults to 0.001
+    :type mr: float, optional
+    :param steps: number of model steps, defaults to 100
+    :type steps: int, optional
+    :param runs: number of replicated runs, defaults to 20
+    :type runs: int, optional
+    :param seed: seed of the first run, defaults to 0
+    :type seed: int, optional
+    :param alpha: probability of failing when the expected dynamics are right, defaults to 0.01
+    :type alpha: float, optional
+    :return: comparison of the runs with the expected dynamics, as returned by validate
+    :rtype: DataFrame
+    """
+    from model import FamilyModel
+
+    data = []
+    for run in range(runs):
+        # FamilyModel draws from the global random module, the scheduler from the random generator of the model
+        random.seed(seed + run)
+        model = FamilyModel(N=N, r=r, dr=dr, mr=mr)
+        model.random.seed(seed + run)
+        for _ in range(steps):
+            model.step()
+        data.append(model.datacollector.get_model_vars_dataframe().assign(N=N, r=r, dr=dr, mr=mr))
+    data = pd.concat(data).rename_axis("Step").reset_index()
+    comparison = validate(data)
+    distance = (comparison["error"] / (comparison["sd"] / np.sqrt(runs))).abs()
+    tol = NormalDist().inv_cdf(1 - alpha / (2 * steps))
+    assert (distance < tol).all(), f"mean of the runs {distance.max():.1f} standard errors from the expected " \
+                                   f"value at step {comparison['Step'][distance.idxmax()]}"
+    return comparison
+
+
+if __name__ == "__main__":
+    data = pd.read_csv("final_data/basic_result.csv", index_col=0)
+    comparison = validate(data)
+    print(comparison)
+    print("\nRMSE\t", np.sqrt((comparison["error"] ** 2).mean()))
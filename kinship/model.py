@@ -1,33 +1,104 @@
+import os
+import sys
 import random
 from mesa import Agent, Model
 from mesa.time import RandomActivation
-from mesa.time import BaseScheduler
 from mesa.datacollection import DataCollector
 import numpy as np
-from utils import FloatBinHandler
+from utils import FloatBinHandler, uniform_crossover, bitflip_mutation
+
+# the scheduler is shared by all the scenarios and lives in the root of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from social_activation import SocialActivation
+from convergence import ConvergenceMonitor
 
 fam_id = -1
 
-class SocialActivation(BaseScheduler):
+class FamilyActivation(SocialActivation):
     """
-    A scheduler which activates each agent once per step, in random order,
-    with the order reshuffled every step but only activate the actors.
+    SocialActivation scheduler which also keeps an index of the agents belonging to each family.
+    The index is updated every time an agent is added or removed, so that the members of a family
+    can be retrieved without scanning the whole population.
 
-    :param BaseScheduler: activates agents one at a time, in the order they were added. 
-    Assumes that each agent added has a step method which takes no arguments.
+    :param SocialActivation: scheduler which activates only the actors, in random order
     """
 
-    def step(self, actors) -> None:
+    def __init__(self, model, key=None, debug=False) -> None:
+        super().__init__(model, key=key, debug=debug)
+        # family_id -> {unique_id: agent}
+        self.families = {}
+
+    def add(self, agent) -> None:
+        """
+        Add an agent to the schedule and to the index of its family
+
+        :param agent: agent to be added
+        :type agent: FamilyAgent
+        """
+        super().add(agent)
+        self.families.setdefault(agent.family, {})[agent.unique_id] = agent
+
+    def remove(self, agent) -> None:
+        """
+        Remove an agent from the schedule and from the index of its family,
+        families with no members left are dropped from the index
+
+        :param agent: agent to be removed
+        :type agent: FamilyAgent
         """
-        Executes the step of all agents, one at a time, in
-        random order.
+        super().remove(agent)
+        members = self.families[agent.family]
+        del members[agent.unique_id]
+        if not members:
+            del self.families[agent.family]
+
+    def add_many(self, agents) -> None:
         """
-        for agent in self.agent_buffer(shuffled=True):
-            if agent.unique_id in actors:
-                agent.step()
+        Add a list of agents to the schedule and to the index of their families
 
-        self.steps += 1
-        self.time += 1
+        :param agents: agents to be added
+        :type agents: list of FamilyAgent
+        """
+        super().add_many(agents)
+        for agent in agents:
+            self.families.setdefault(agent.family, {})[agent.unique_id] = agent
+
+    def remove_many(self, agents) -> None:
+        """
+        Remove a list of agents from the schedule and from the index of their families
+
+        :param agents: agents to be removed
+        :type agents: list of FamilyAgent
+        """
+        super().remove_many(agents)
+        for agent in agents:
+            members = self.families[agent.family]
+            del members[agent.unique_id]
+            if not members:
+                del self.families[agent.family]
+
+    def swap_generation(self, agents) -> None:
+        """
+        Replace all the agents in the schedule with a new generation, the index of the families is rebuilt
+
+        :param agents: agents of the new generation
+        :type agents: list of FamilyAgent
+        """
+        super().swap_generation(agents)
+        self.families = {}
+        for agent in agents:
+            self.families.setdefault(agent.family, {})[agent.unique_id] = agent
+
+    def family_members(self, family_id):
+        """
+        Members of a family
+
+        :param family_id: identifier of the family
+        :type family_id: int
+        :return: all agents currently in the schedule belonging to the family
+        :rtype: list
+        """
+        return list(self.families.get(family_id, {}).values())
 
 
 class FamilyAgent(Agent):
@@ -74,8 +145,8 @@ class FamilyAgent(Agent):
             else:
                 self.model.schedule.remove(self)
         else:
-            [self.model.schedule.remove(a) for a in self.model.schedule.agent_buffer() 
-            if a.family == self.family and a.unique_id != self.unique_id]
+            [self.model.schedule.remove(a) for a in self.model.schedule.family_members(self.family)
+             if a.unique_id != self.unique_id]
 
 
 class FamilyModel(Model):
@@ -87,7 +158,7 @@ class FamilyModel(Model):
     :type Model: mesa.model
     """
 
-    def __init__(self, N=500, r=0.5, dr=0.95, mr=0.001):
+    def __init__(self, N=500, r=0.5, dr=0.95, mr=0.001, stop_window=0, stop_tol=0.01, debug=False):
         """
         A model for simulation of the evolution of families.
 
@@ -99,20 +170,45 @@ class FamilyModel(Model):
         :type dr: float, optional
         :param mr: mutation rate, defaults to 0.001 
         :type mr: float, optional
+        :param stop_window: number of steps of the rolling window used to detect a steady state and stop the run
+        early, 0 to always run until max_steps, defaults to 0
+        :type stop_window: int, optional
+        :param stop_tol: maximum variation of the monitored fractions within the window, defaults to 0.01
+        :type stop_tol: float, optional
+        :param debug: cross-check the counters of the scheduler against a full scan of the agents at every
+        reading, defaults to False
+        :type debug: bool, optional
         """
 
-        self.schedule = SocialActivation(self)
+        # the scheduler counts the agents carrying each allele of the altruistic gene
+        self.schedule = FamilyActivation(self, key=self.altruistic_allele, debug=debug)
         self.N = N
         self.mr = mr
         self.dr = dr
         self.running = True
-        self.datacollector = DataCollector(model_reporters={"altruistic fraction": lambda x: len(
-            [a for a in x.schedule.agent_buffer() if a.genotype == 1]) / x.schedule.get_agent_count()})
+        # without mutation the fixation and the loss of the altruistic allele are absorbing states
+        self.monitor = ConvergenceMonitor(stop_window, stop_tol, absorbing=(0.0, 1.0) if mr == 0 else ()) \
+            if stop_window else None
+        self.stop_step = None
+        self.datacollector = DataCollector(model_reporters={
+            "altruistic fraction": lambda x: x.schedule.class_count(1) / x.schedule.get_agent_count()})
 
         self.add_agents(N, r)
 
         self.reproduce()
 
+    @staticmethod
+    def altruistic_allele(agent):
+        """
+        Allele of the altruistic gene carried by an agent
+
+        :param agent: a model agent
+        :type agent: FamilyAgent
+        :return: 1 for altruist, 0 for non-altruist
+        :rtype: int
+        """
+        return agent.genotype
+
     def add_agents(self, N, r):
         """
         Add agents to the model with the right proportion (r) of altruistic allele
@@ -138,8 +234,7 @@ class FamilyModel(Model):
         1. Sample N individuals from current population
         2. Generate pairs of individuals
         3. Create the new generation, defining inherited genotype (mutation applied) and family ID
-        4. Remove all the "old" agents from the model
-        5. Add the new generation of agents to the model
+        4. Replace the "old" agents with the new generation in the model
         """
         # 1
         mating_ind = random.sample([agent for agent in self.schedule.agents], k=self.N)
@@ -151,9 +246,8 @@ class FamilyModel(Model):
         newgen = [{"genotype": mutate(random.choice([a.genotype for a in p])), "family": p[0].unique_id}
                   for p in mating_pairs for i in range(3)]
         # 4
-        [self.schedule.remove((a)) for a in self.schedule.agent_buffer()]
-        # 5
-        [self.schedule.add(FamilyAgent(i, self, newgen[i]["genotype"], newgen[i]["family"])) for i in range(len(newgen))]
+        self.schedule.swap_generation([FamilyAgent(i, self, newgen[i]["genotype"], newgen[i]["family"])
+                                       for i in range(len(newgen))])
 
     def step(self) -> None:
         """
@@ -169,12 +263,11 @@ class FamilyModel(Model):
         # proportion of the dangerous rooms is compute in such a way to ensure enough agents survive to 
         # generate the next generation
         danger_number = self.N // 4
-        ufid = list(set([a.family for a in self.schedule.agent_buffer()]))
+        ufid = list(self.schedule.families)
 
         # we just deal with families in dangerous scenario to save computations
         danger_fam = random.sample(ufid, danger_number)
-        rooms = [[x for x in self.schedule.agent_buffer() if x.family == f]
-                 for f in danger_fam]
+        rooms = [self.schedule.family_members(f) for f in danger_fam]
         
         # defining the actor randomly
         active = [random.choice(r).unique_id for r in rooms]
@@ -185,3 +278,5 @@ class FamilyModel(Model):
         self.reproduce()
 
         self.datacollector.collect(self)
+        if self.monitor is not None:
+            self.monitor.update(self)
@@ -1,6 +1,8 @@
 import random
 import numpy as np
 from model import *
+from selection import SELECTION
+from utils import TraitHistogram
 
 
 class MultigeneFamilyAgent(FamilyAgent):
@@ -9,12 +11,39 @@ class MultigeneFamilyAgent(FamilyAgent):
 
     :param FamilyAgent: Agent class to simulate altruistic behaviour based on relatedness
     :type FamilyAgent: FamilyAgent
-    :param genotype: list of [trait1, trait2]
-    
+
+    The genotype is not stored in the agent but packed in an unsigned integer of the model genome array,
+    at the index given by the unique_id of the agent. It is exposed as list of [trait1, trait2]
+
     trait1: binary gene, allele 1 codes for altruism allele 0 for cowardice
-    trait2: real number coded as bin, from 0 to 1 
+    trait2: real number from 0 to 1 coded as bin
     """
 
+    def __init__(self, unique_id, model, family_id: int):
+        """
+        Agent class to simulate altruistic behaviour based on relatedness where genotype contains two genes
+
+        :param unique_id: a unique numeric identifier for the agent model, index of its genotype in model.genome
+        :type unique_id: int
+        :param model:  instance of the model that contains the agent
+        :type model: MultigeneFamilyModel
+        :param family_id: identifier for the whole family, namely all individuals generated from the same parents
+        :type family_id: int
+        """
+        Agent.__init__(self, unique_id, model)
+        self.family = family_id
+
+    @property
+    def genotype(self):
+        """
+        Genotype of the agent unpacked from the model genome
+
+        :return: [trait1, trait2], trait2 is the binary code of the float packed in an int
+        :rtype: list
+        """
+        g = int(self.model.genome[self.unique_id])
+        return [g >> self.model.handler.length, g & self.model.handler.mask]
+
     def altruistic_action(self):
         """
         Implementation of a generic altruistic action. 
@@ -27,8 +56,8 @@ class MultigeneFamilyAgent(FamilyAgent):
             else:
                 self.model.schedule.remove(self)
         else:
-            [self.model.schedule.remove(a) for a in self.model.schedule.agent_buffer()
-             if a.family == self.family and a.unique_id != self.unique_id]
+            [self.model.schedule.remove(a) for a in self.model.schedule.family_members(self.family)
+             if a.unique_id != self.unique_id]
 
 
 class MultigeneFamilyModel(FamilyModel):
@@ -39,7 +68,8 @@ class MultigeneFamilyModel(FamilyModel):
     :type FamilyModel: FamilyModel
     """
 
-    def __init__(self, N=500, r=0.5, dr=0.95, mr=0.001):
+    def __init__(self, N=500, r=0.5, dr=0.95, mr=0.001, selection="weighted", histogram_bins=20,
+                 stop_window=0, stop_tol=0.01, debug=False):
         """
         Extension of the FamilyModel in order to deal with genotype with two genes
 
@@ -51,6 +81,20 @@ class MultigeneFamilyModel(FamilyModel):
         :type dr: float, optional
         :param mr: mutation rate, defaults to 0.001
         :type mr: float, optional
+        :param selection: selection scheme of the parents based on the fitness of trait2, one of "weighted"
+        (fitness proportional without replacement), "sus" (stochastic universal sampling) and "tournament",
+        defaults to "weighted"
+        :type selection: str, optional
+        :param histogram_bins: number of bins of the per-step histograms of trait2, defaults to 20
+        :type histogram_bins: int, optional
+        :param stop_window: number of steps of the rolling window used to detect a steady state and stop the run
+        early, 0 to always run until max_steps, defaults to 0
+        :type stop_window: int, optional
+        :param stop_tol: maximum variation of the monitored fractions within the window, defaults to 0.01
+        :type stop_tol: float, optional
+        :param debug: cross-check the counters of the scheduler against a full scan of the agents at every
+        reading, defaults to False
+        :type debug: bool, optional
         """
 
         # Defining stddev and mean of first mode for the bimodal fitness landscape for trait2. 
@@ -60,23 +104,25 @@ class MultigeneFamilyModel(FamilyModel):
 
         # Setting the conversion from float to binary 
         self.handler = FloatBinHandler(3, 1)
+        # the genotype of each agent is packed in a single int: trait2 in the lowest bits, trait1 in the next one
+        self.genome_length = self.handler.length + 1
+        self.select = SELECTION[selection]
 
-        super().__init__(N=N, r=r, dr=dr, mr=mr)
+        super().__init__(N=N, r=r, dr=dr, mr=mr, stop_window=stop_window, stop_tol=stop_tol, debug=debug)
 
-        self.datacollector = DataCollector(model_reporters={
-            "altruistic fraction": lambda x: len(
-                [a for a in x.schedule.agent_buffer() if a.genotype[0] == 1]) / x.schedule.get_agent_count(),
-            "mean rep": lambda x: sum([x.reproductive_fitness_multimodal(a) for a in x.schedule.agent_buffer()]) / len(
-                [x.reproductive_fitness_multimodal(a) for a in x.schedule.agent_buffer()]),
-            "max rep": lambda x: max([x.reproductive_fitness_multimodal(a) for a in x.schedule.agent_buffer()]),
-            "min rep": lambda x: min([x.reproductive_fitness_multimodal(a) for a in x.schedule.agent_buffer()]),
-            "mean rep1": lambda x: sum(
-                [x.reproductive_fitness_multimodal(a) for a in x.schedule.agent_buffer() if a.genotype[0] == 1]) / len(
-                [x.reproductive_fitness_multimodal(a) for a in x.schedule.agent_buffer() if a.genotype[0] == 1]),
-            "mean rep0": lambda x: sum(
-                [x.reproductive_fitness_multimodal(a) for a in x.schedule.agent_buffer() if a.genotype[0] == 0]) / len(
-                [x.reproductive_fitness_multimodal(a) for a in x.schedule.agent_buffer() if a.genotype[0] == 0])
+        # distribution of the phenotype of trait2 at each step, class 1 altruists and class 0 non-altruists,
+        # together with the means of the fitness landscape at the same step
+        self.trait2_histogram = TraitHistogram(histogram_bins, 2)
+        self.landscape = []
 
+        # reporters are computed right after reproduce, when the genome array holds exactly the living generation
+        self.datacollector = DataCollector(model_reporters={
+            "altruistic fraction": lambda x: x.schedule.class_count(1) / x.schedule.get_agent_count(),
+            "mean rep": lambda x: x.fitness.mean(),
+            "max rep": lambda x: x.fitness.max(),
+            "min rep": lambda x: x.fitness.min(),
+            "mean rep1": lambda x: x.mean_fitness(1),
+            "mean rep0": lambda x: x.mean_fitness(0)
         })
 
     def add_agents(self, N, r):
@@ -88,17 +134,26 @@ class MultigeneFamilyModel(FamilyModel):
         :param r: initial ratio of altruistic allele
         :type r: float
         """
-        # adding altruist agents (genotype[0] = 1)
-        for i in range(int(N * r)):
-            trait2 = self.handler.float2bin(random.random())
-            agent = MultigeneFamilyAgent(i, self, [1, trait2], i)
-            self.schedule.add(agent)
+        # altruist agents (genotype[0] = 1) come first, then the non-altruist ones (genotype[0] = 0)
+        trait1 = np.zeros(N, dtype=np.uint32)
+        trait1[:int(N * r)] = 1
+        trait2 = self.handler.float2bin(np.random.random(N))
+        self.genome = (trait1 << self.handler.length) | trait2
 
-        # adding non-altruist agents (genotype[0] = 0)
-        for i in range(int(N * r), N):
-            trait2 = self.handler.float2bin(random.random())
-            agent = MultigeneFamilyAgent(i, self, [0, trait2], i)
-            self.schedule.add(agent)
+        for i in range(N):
+            self.schedule.add(MultigeneFamilyAgent(i, self, i))
+
+    @staticmethod
+    def altruistic_allele(agent):
+        """
+        Allele of the altruistic gene (trait1) carried by an agent
+
+        :param agent: a model agent
+        :type agent: MultigeneFamilyAgent
+        :return: 1 for altruist, 0 for non-altruist
+        :rtype: int
+        """
+        return agent.genotype[0]
 
     def reproductive_fitness_multimodal(self, agent):
         """
@@ -110,10 +165,33 @@ class MultigeneFamilyModel(FamilyModel):
         :return: fitness of trait2
         :rtype: float
         """
-        phenotype = self.handler.bin2float(agent.genotype[1])
+        return self.fitness_table[self.genome[agent.unique_id] & self.handler.mask]
+
+    def fitness_lookup_table(self):
+        """
+        Bimodal fitness landscape evaluated for every possible binary code of trait2.
+        Phenotypes are discrete so the fitness of the whole population is just a lookup in this table,
+        which must be rebuilt only when the means of the landscape change.
+
+        :return: fitness of each binary code of trait2
+        :rtype: np.ndarray
+        """
+        phenotype = self.handler.bin2float(np.arange(1 << self.handler.length))
+
+        return np.maximum(np.exp(-((phenotype - self.mean[0]) / self.sd) ** 2),
+                          np.exp(-((phenotype - self.mean[1]) / self.sd) ** 2))
+
+    def mean_fitness(self, trait1):
+        """
+        Mean fitness of the agents with the given allele of trait1
 
-        return max(np.exp(-((phenotype - self.mean[0]) / self.sd) ** 2),
-                   np.exp(-((phenotype - self.mean[1]) / self.sd) ** 2))
+        :param trait1: allele of trait1 (1: altruist, 0: non-altruist)
+        :type trait1: int
+        :return: mean fitness, nan if no agent carries the allele
+        :rtype: float
+        """
+        fitness = self.fitness[(self.genome >> self.handler.length) == trait1]
+        return fitness.mean() if len(fitness) else float("nan")
 
     def update_fitness(self):
         """
@@ -132,30 +210,31 @@ class MultigeneFamilyModel(FamilyModel):
             m2 = random.choice([random.uniform(m1 + 0.2, 1), random.uniform(0, m1 - 0.2)])
         return [m1, m2]
 
-    def trait2_computation(self, parent1, parent2):
+    def record_trait2(self):
+        """
+        Records the histograms of the phenotype of trait2 of the current generation, for altruists and
+        non-altruists, and the means of the fitness landscape
         """
-        Inheritance of trait2, based on on trait2 of both parents. Thanks to binary representation 
-        we can easily perform both crossover and mutation
+        self.trait2_histogram.record(self.handler.bin2float(self.genome), self.genome >> self.handler.length)
+        self.landscape.append(list(self.mean))
 
-        :param parent1: first agent of the couple generating offspring
-        :type parent1: MultigeneFamilyAgent
-        :param parent2: second agent of the couple generating offspring
-        :type parent2: MultigeneFamilyAgent
-        :return: trait2 of the offspring
-        :rtype: str
+    def save_trait2(self, path):
         """
-        # crossover
-        gene_offspring = ''
-        for p1, p2 in zip(parent1.genotype[1], parent2.genotype[1]):
-            gene_offspring += random.choice((p1, p2))
+        Saves the recorded histograms of trait2 in a compressed .npz file: "counts" (steps x 2 x bins, class 1
+        altruists and class 0 non-altruists), "edges" of the bins and "landscape" (steps x 2) means of the
+        fitness landscape
 
-        # mutation
-        mutate = lambda x: x if random.random() > self.mr else str(1 - int(x))
-        gene_offspring_mutated = '0b'
-        for g in gene_offspring[2:]:
-            gene_offspring_mutated += mutate(g)
+        :param path: output file
+        :type path: str
+        """
+        self.trait2_histogram.save(path, landscape=np.array(self.landscape))
 
-        return gene_offspring_mutated
+    def step(self) -> None:
+        """
+        Model step of the FamilyModel, then the distribution of trait2 of the new generation is recorded
+        """
+        super().step()
+        self.record_trait2()
 
     def reproduce(self):
         """
@@ -163,36 +242,40 @@ class MultigeneFamilyModel(FamilyModel):
         1. Sample N individuals from current population
         2. Generate pairs of inidividuals
         3. Create the new generation, defining inherited genotype (mutation applied) and family ID
-        4. Remove all the "old" agents from the model
-        5. Add the new generation of agents to the model
+        4. Replace the "old" agents with the new generation in the model
         """
         # in first and every 100 steps we change the fitness landscape to simulate dynamic environment
+        # the fitness of each agent is cached once per generation and recomputed only when the landscape changes
         if self.schedule.steps % 100 == 0:
             self.mean = self.update_fitness()
+            self.fitness_table = self.fitness_lookup_table()
+            self.fitness = self.fitness_table[self.genome & self.handler.mask]
 
         # 1
-        total_rep_fitness = np.array([self.reproductive_fitness_multimodal(a) for a in self.schedule.agents])
-        total_rep_fitness /= total_rep_fitness.sum()
+        ids = np.fromiter((a.unique_id for a in self.schedule.agent_buffer()), dtype=int)
 
         # based on the fitness of trait2 we assign more or less probability to reproduce to each agent
-        mating_ind = np.random.choice(self.schedule.agents, self.N, replace=False, p=total_rep_fitness)
+        mating_ind = ids[self.select(self.fitness[ids], self.N)]
 
         # 2
-        mating_pairs = [(mating_ind[i], mating_ind[i + len(mating_ind) // 2])
-                        for i in range(len(mating_ind) // 2)]
+        half = len(mating_ind) // 2
+        p1 = np.repeat(mating_ind[:half], 3)
+        p2 = np.repeat(mating_ind[half:2 * half], 3)
         # 3
-        mutate = lambda x: x if random.random() > self.mr else 1 - x
-        newgen = [{"genotype": [mutate(random.choice([a.genotype[0] for a in p])),
-                                self.trait2_computation(p[0], p[1])],
-                   "family": p[0].unique_id} for p in mating_pairs for i in range(3)]
+        # the whole genotype is inherited at once: uniform crossover with a random bit mask, then mutation
+        # of each bit with a random XOR mask
+        genome = uniform_crossover(self.genome[p1], self.genome[p2], self.genome_length)
+        genome = bitflip_mutation(genome, self.genome_length, self.mr)
         # 4
-        [self.schedule.remove(a) for a in self.schedule.agent_buffer()]
-        # 5
-        [self.schedule.add(MultigeneFamilyAgent(i, self, newgen[i]["genotype"], newgen[i]["family"]))
-         for i in range(len(newgen))]
-
+        self.genome = genome
+        self.fitness = self.fitness_table[genome & self.handler.mask]
+        # with selection schemes with replacement the same parent can be in more pairs, so the family is
+        # identified by the index of the pair instead of the unique_id of the first parent
+        family = np.repeat(np.arange(half), 3).tolist()
+        self.schedule.swap_generation([MultigeneFamilyAgent(i, self, family[i]) for i in range(len(genome))])
 
 if __name__ == "__main__":
     model = MultigeneFamilyModel(N=1000, mr=0.001, r=0.5)
     for i in range(100):
         model.step()
+    model.save_trait2("data/multi_trait2.npz")
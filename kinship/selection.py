@@ -0,0 +1,79 @@
+import numpy as np
+
+
+def weighted_sample(weights, k, rng=np.random):
+    """
+    Weighted sampling of k indices without replacement, same distribution of
+    np.random.choice(len(weights), k, replace=False, p=weights / weights.sum()).
+    Each index gets the random key log(u) / w, with u uniform in (0, 1), and the k largest keys are selected
+    (exponential keys, Efraimidis and Spirakis): one random number per individual and a partial sort,
+    so the cost is linear in the population size.
+
+    :param weights: non-negative weight of each individual, not necessarily normalized
+    :type weights: np.ndarray
+    :param k: number of individuals to be sampled
+    :type k: int
+    :param rng: random number generator, defaults to the numpy global one
+    :type rng: np.random.Generator or np.random.RandomState, optional
+    :return: indices of the sampled individuals, in random order
+    :rtype: np.ndarray
+    """
+    weights = np.asarray(weights, dtype=float)
+    if k > np.count_nonzero(weights):
+        raise ValueError("Fewer non-zero weights than individuals to be sampled")
+
+    with np.errstate(divide="ignore"):
+        keys = np.log(1 - rng.random(len(weights))) / weights
+    # the selected indices are the k largest keys, they are not sorted by key so they are shuffled
+    selected = np.argpartition(keys, len(keys) - k)[len(keys) - k:]
+    return rng.permutation(selected)
+
+
+def stochastic_universal_sampling(weights, k, rng=np.random):
+    """
+    Stochastic universal sampling of k indices (with replacement): k equally spaced pointers, with a single
+    random offset, over the cumulative weights. The number of copies of each individual differs from its
+    expected value (k * w / sum(w)) by less than one.
+
+    :param weights: non-negative weight of each individual, not necessarily normalized
+    :type weights: np.ndarray
+    :param k: number of individuals to be sampled
+    :type k: int
+    :param rng: random number generator, defaults to the numpy global one
+    :type rng: np.random.Generator or np.random.RandomState, optional
+    :return: indices of the sampled individuals, in random order
+    :rtype: np.ndarray
+    """
+    cumulative = np.cumsum(weights, dtype=float)
+    pointers = (rng.random() + np.arange(k)) * (cumulative[-1] / k)
+    # pointers are sorted, so the selected individuals must be shuffled before pairing them
+    selected = np.minimum(np.searchsorted(cumulative, pointers, side="right"), len(cumulative) - 1)
+    return rng.permutation(selected)
+
+
+def tournament(weights, k, rng=np.random, size=2):
+    """
+    Tournament selection of k indices (with replacement): for each of the k tournaments, size contestants
+    are drawn uniformly and the one with the highest weight wins.
+
+    :param weights: weight of each individual
+    :type weights: np.ndarray
+    :param k: number of individuals to be sampled
+    :type k: int
+    :param rng: random number generator, defaults to the numpy global one
+    :type rng: np.random.Generator or np.random.RandomState, optional
+    :param size: number of contestants in each tournament, defaults to 2
+    :type size: int, optional
+    :return: indices of the sampled individuals
+    :rtype: np.ndarray
+    """
+    weights = np.asarray(weights)
+    contestants = (rng.random((k, size)) * len(weights)).astype(int)
+    winner = np.argmax(weights[contestants], axis=1)
+    return contestants[np.arange(k), winner]
+
+
+# selection schemes available to the models
+SELECTION = {"weighted": weighted_sample,
+             "sus": stochastic_universal_sampling,
+             "tournament": tournament}
@@ -1,158 +1,307 @@
-import networkx as nx
-import igraph as ig
+import numpy as np
 
 
 class FloatBinHandler:
 
     def __init__(self, precision: int, max_value):
         """
-        Handler functions to quickly and easily convert floats to bins with padding, useful when encoding genotypes
-        since all the binary representation must be of the same length
+        Handler functions to quickly and easily convert floats to fixed length binary codes, useful when encoding
+        genotypes since all the binary representation must be of the same length.
+        Binary codes are stored packed in unsigned integers, all the functions work both on scalars and numpy arrays
         :param precision: number of decimals to be considered
         :param max_value: maximum value of the float numbers to be converted, needed for padding
         """
         self.precision = precision
         # conversion constant needed to transform floeat into int
         self.const = 10**precision
-        # length of the padded bin string
+        # number of bits of the binary code
         self.length = len(bin(int(max_value * self.const))) - 2
+        # mask selecting the bits of the binary code
+        self.mask = (1 << self.length) - 1
 
-    def float2bin(self, f: float):
+    def float2bin(self, f):
         """
-        Coverts float to binary sting
-        :param f: float to be converted
-        :return: binary sting with buffer
+        Coverts floats to binary codes
+        :param f: float or array of floats to be converted
+        :return: binary codes packed in unsigned integers
         """
-        b = bin(int(f * self.const))
-        pb = "0b" + b[2:].zfill(self.length)
-        return pb
+        return (np.asarray(f) * self.const).astype(np.uint32)
 
-    def bin2float(self, b: str):
+    def bin2float(self, b):
         """
-        Converts binary string to float
-        :param b: Binary string
+        Converts binary codes to floats, bits above the length of the code are ignored
+        :param b: binary code or array of binary codes packed in unsigned integers
         :return: float conversion
         """
-        return int(b, 2) / self.const
+        return (np.asarray(b) & self.mask) / self.const
 
 
-class IBDFamilyTree:
+def uniform_crossover(g1, g2, length):
     """
-    DAG to deal with genealogy of agents in the model
+    Uniform crossover of packed genotypes: each bit of the offspring is taken from the first or the second
+    parent according to a random bit mask
+    :param g1: genotypes of the first parents
+    :type g1: np.ndarray of unsigned integers
+    :param g2: genotypes of the second parents
+    :type g2: np.ndarray of unsigned integers
+    :param length: number of bits of the genotypes
+    :type length: int
+    :return: genotypes of the offspring
+    :rtype: np.ndarray
     """
+    mask = np.random.randint(0, 1 << length, size=len(g1), dtype=g1.dtype)
+    return (g1 & mask) | (g2 & ~mask)
 
-    def __init__(self, G: nx.DiGraph, model):
+
+def bitflip_mutation(g, length, mr):
+    """
+    Mutation of packed genotypes: each bit is flipped with probability mr by XOR-ing a random mask
+    :param g: genotypes to be mutated
+    :type g: np.ndarray of unsigned integers
+    :param length: number of bits of the genotypes
+    :type length: int
+    :param mr: mutation rate of each bit
+    :type mr: float
+    :return: mutated genotypes
+    :rtype: np.ndarray
+    """
+    flips = (np.random.random((len(g), length)) < mr).astype(g.dtype)
+    mask = (flips << np.arange(length, dtype=g.dtype)).sum(axis=1, dtype=g.dtype)
+    return g ^ mask
+
+
+class TraitHistogram:
+
+    def __init__(self, bins: int, classes: int, steps=100, low=0.0, high=1.0):
         """
-        :param G: _description_
-        :type G: nx.DiGraph
-        :param model: associated model
-        :type model: IBDFamilyModel
+        Per-step fixed-bin histograms of a real valued trait, one for each class of individuals.
+        Counts are stored in a preallocated (steps x classes x bins) array, doubled when it gets full, so a
+        long run costs a few integers per step instead of one row per individual.
+        Values outside [low, high] are counted in the first or in the last bin.
+        :param bins: number of bins
+        :param classes: number of classes of individuals, classes are identified by 0, 1, ..., classes - 1
+        :param steps: number of steps initially allocated, defaults to 100
+        :param low: lower edge of the first bin, defaults to 0
+        :param high: higher edge of the last bin, defaults to 1
         """
+        self.bins = bins
+        self.classes = classes
+        self.edges = np.linspace(low, high, bins + 1)
+        self.counts = np.zeros((steps, classes, bins), dtype=np.int32)
+        self.steps = 0
 
-        self.G = G
-        self.ig = ig.Graph.from_networkx(G)
-        self.model = model
+    def record(self, values, classes):
+        """
+        Adds the histograms of a step
+        :param values: trait of each individual
+        :type values: np.ndarray
+        :param classes: class of each individual
+        :type classes: np.ndarray of int
+        """
+        if self.steps == len(self.counts):
+            self.counts = np.concatenate([self.counts, np.zeros_like(self.counts)])
+        low, high = self.edges[0], self.edges[-1]
+        b = np.clip(((np.asarray(values) - low) / (high - low) * self.bins).astype(int), 0, self.bins - 1)
+        self.counts[self.steps] = np.bincount(np.asarray(classes) * self.bins + b,
+                                              minlength=self.classes * self.bins).reshape(self.classes, self.bins)
+        self.steps += 1
 
-    def ibd_coeff(self, n1, n2):
+    @property
+    def histograms(self):
+        """
+        Recorded histograms
+        :return: counts of each step, class and bin
+        :rtype: np.ndarray of shape (steps, classes, bins)
         """
-        computing relatedness between two agents based on lowest common ancestor in the DAG
-        using only networkx
+        return self.counts[:self.steps]
 
-        :param n1: first agent
-        :type n1: IBDFamilyAgent
-        :param n2: second agent
-        :type n2: IBDFamilyAgent
-        :return: relatedness score
-        :rtype: float
+    def save(self, path, **arrays):
+        """
+        Saves the recorded histograms and the bin edges in a compressed .npz file
+        :param path: output file
+        :param arrays: additional per-step arrays to be saved together with the histograms
         """
-        ancestor = nx.algorithms.lowest_common_ancestor(self.G, n1, n2)
+        np.savez_compressed(path, counts=self.histograms, edges=self.edges, **arrays)
 
-        if not ancestor:
-            return 0
 
-        pl = nx.algorithms.shortest_path_length(
-            self.G, source=ancestor, target=n1)
+class Pedigree:
+    """
+    Genealogy of the agents in the model, stored as a ring buffer of generations.
+    Each generation is an integer array with, for each individual, the indices of its two parents in the
+    previous generation. Adding a generation overwrites the oldest one, so both operations cost O(generation size).
+
+    Ancestor queries are answered by an index of ancestor bitsets: for each generation back, a packed bitset
+    of the ancestors of every family (all individuals generated from the same parents share the same ancestors)
+    of the current generation. The bitsets of a generation are the union of the bitsets of the parents; the index
+    is built on the first query after a new generation, so adding generations that are never queried stays O(n).
+    """
 
-        return 0.5 ** pl
+    def __init__(self, N: int, depth: int):
+        """
+        :param N: number of founders
+        :type N: int
+        :param depth: number of generations of parents stored, e.g. 2 keeps parents and grandparents of the
+        current generation
+        :type depth: int
+        """
+        self.depth = depth
+        self.parents = [None] * depth
+        # slot of the ring buffer holding the current generation
+        self.head = -1
+        # number of generations stored so far, at most depth
+        self.size = 0
+        # number of individuals of the current generation
+        self.n = N
+        # family index of each individual of the current generation, founders have no family
+        self.family = None
+        # for each stored generation: family index of each individual, parents of each family and size of the
+        # generation of the parents
+        self.families = [None] * depth
+        self.family_parents = [None] * depth
+        self.widths = [None] * depth
+        # ancestor bitsets of the current generation, None until the first query
+        self._ancestor_sets = None
 
-    def ig_ibd_coeff(self, n1, n2):
+    def add_generation(self, parents):
         """
-        computing relatedness between two agents based on lowest common ancestor in the DAG
-        using igraph
+        Adding a new generation to the pedigree, the oldest one is dropped if the buffer is full
 
-        :param n1: first agent
-        :type n1: IBDFamilyAgent
-        :param n2: second agent
-        :type n2: IBDFamilyAgent
-        :return: relatedness score
-        :rtype: float
+        :param parents: indices in the previous generation of the two parents of each individual
+        :type parents: array-like of shape (n, 2)
         """
-        ancestor = self.ig_LCA(n1, n2)
-        if type(ancestor) != int:
-            return 0
-        v1 = self.ig.vs(lambda x: x["_nx_name"] == n1)[0]
-        p = self.ig.get_shortest_paths(ancestor, to=v1, output="vpath")[0]
-        pl = len(p) - 1
-        return 0.5 ** pl
+        parents = np.asarray(parents, dtype=np.int64).reshape(-1, 2)
+        self.head = (self.head + 1) % self.depth
+        self.parents[self.head] = parents
+        self.size = min(self.size + 1, self.depth)
 
-    def ig_LCA(self, n1, n2):
+        # every individual mates only once, so the first parent identifies the family
+        _, first, family = np.unique(parents[:, 0], return_index=True, return_inverse=True)
+        self.families[self.head] = family
+        self.family_parents[self.head] = parents[first]
+        self.widths[self.head] = self.n
+
+        self.family = family
+        self.n = len(parents)
+        self._ancestor_sets = None
+
+    @property
+    def ancestor_sets(self):
         """
-        Computing lowest common ancestor
+        Packed bitsets of the ancestors of each family of the current generation, built from the oldest stored
+        generation: the parents of each family are set directly in the packed array, older ancestors are the
+        union of the ancestors of the two parents
 
-        :param n1: first agent
-        :type n1: IBDFamilyAgent
-        :param n2: second agent
-        :type n2: IBDFamilyAgent
-        :return: _description_ id of LCA in the graph
-        :rtype: _type_ int
+        :return: ancestor_sets[k] holds the packed bitsets of the ancestors k + 1 generations back of each family
+        :rtype: list of np.ndarray
         """
-        v1, v2 = self.ig.vs(lambda x: x["_nx_name"] == n1)[0], self.ig.vs(lambda x: x["_nx_name"] == n2)[0]
-        lca = self.rLCA(v1, v2)
-        if lca:
-            return lca[0]
-        else:
-            return None
+        if self._ancestor_sets is None:
+            sets, parent_family = [], None
+            for back in range(self.size - 1, -1, -1):
+                slot = (self.head - back) % self.depth
+                family_parents = self.family_parents[slot]
+                # parents of each family, bit p of a row is bit 7 - p % 8 of byte p // 8 as in np.packbits
+                parent_sets = np.zeros((len(family_parents), (self.widths[slot] + 7) // 8), dtype=np.uint8)
+                rows = np.repeat(np.arange(len(family_parents)), 2)
+                bits = family_parents.ravel()
+                np.bitwise_or.at(parent_sets, (rows, bits >> 3), (0x80 >> (bits & 7)).astype(np.uint8))
+                sets = [parent_sets] + [s[parent_family[family_parents[:, 0]]] | s[parent_family[family_parents[:, 1]]]
+                                        for s in sets]
+                parent_family = self.families[slot]
+            self._ancestor_sets = sets
+        return self._ancestor_sets
 
-    def rLCA(self, v1, v2):
+    def generation(self, back=0):
         """
-        Recursive function to find LCA, should not be called directly, use ig_LCA instead
-        :param v1: id of first vertex
-        :param v2: id of second vertex
-        :return:
+        Parents array of a stored generation
+
+        :param back: number of generations before the current one, 0 is the current generation
+        :type back: int
+        :return: indices of the two parents of each individual of the generation
+        :rtype: np.ndarray of shape (n, 2)
         """
-        p1, p2 = self.ig.predecessors(v1), self.ig.predecessors(v2)
-        i = [value for value in p1 if value in p2]
-        if len(i) > 0:
-            return i
-        else:
-            for a1 in p1:
-                for a2 in p2:
-                    return self.rLCA(a1, a2)
+        return self.parents[(self.head - back) % self.depth]
 
-    def remove_generation(self, gen_id):
+    def ancestors(self, i, k):
         """
-        Removing an entire  generation from the DAG
+        Ancestors of an individual of the current generation
 
-        :param gen_id:  ID of the generation to remove
-        :type gen_id: int
+        :param i: index of the individual in the current generation
+        :type i: int
+        :param k: number of generations back, at most the number of stored generations
+        :type k: int
+        :return: indices of the ancestors in the generation k steps back
+        :rtype: np.ndarray
         """
-        gen = [n for n in self.G.nodes if n.split("#")[0] == str(gen_id)]
-        self.G.remove_nodes_from(gen)
+        return np.flatnonzero(np.unpackbits(self.ancestor_sets[k - 1][self.family[i]]))
 
-    def add_child(self, child, cid):
+    def ibd_coeff(self, i, j):
         """
-        Adding agent to the DAG
+        Computing relatedness between two individuals of the current generation based on their nearest
+        common ancestor: 0.5 ** (number of generations between the individuals and the ancestor)
 
-        :param child: agents to be added
-        :type child: IBDFamilyAgent
-        :param cid: child ID for the graph
-        :type cid: str
+        :param i: index of the first individual in the current generation
+        :type i: int
+        :param j: index of the second individual in the current generation
+        :type j: int
+        :return: relatedness score, 0 if there is no common ancestor in the stored generations
+        :rtype: float
         """
-        pid = [f"{self.model.schedule.steps - 1}#{p}" for p in child["parents id"]]
-        self.G.add_edges_from([[p, f"{self.model.schedule.steps}#{cid}"] for p in pid])
+        fi, fj = self.family[i], self.family[j]
+        for back, sets in enumerate(self.ancestor_sets):
+            if np.bitwise_and(sets[fi], sets[fj]).any():
+                return 0.5 ** (back + 1)
+        return 0
+
 
-    def update_ig(self):
+class KinshipMatrix:
+    """
+    Relatedness of the individuals of the current generation, updated every generation from the parents of
+    the new individuals with the same semantics of Pedigree.ibd_coeff: 0.5 ** (number of generations to the
+    nearest common ancestor). Siblings always share the same relatedness with everyone else, so the matrix is
+    stored between families (all individuals generated from the same parents) instead of individuals
+    """
+
+    def __init__(self, N: int, depth: int):
+        """
+        :param N: number of founders, they are unrelated and each one is a family on its own
+        :type N: int
+        :param depth: number of generations of ancestors considered, relatedness lower than 0.5 ** depth is 0
+        :type depth: int
         """
-        update igraph DAG from networkx DAG
+        self.depth = depth
+        # family index of each individual of the current generation
+        self.family = np.arange(N)
+        # relatedness between families, the diagonal is the relatedness between siblings
+        self.R = np.zeros((N, N))
+
+    def add_generation(self, parents):
+        """
+        Computing the relatedness of a new generation from the relatedness of the previous one:
+        siblings are related by 0.5, otherwise relatedness is half the highest one among the pairs of parents
+
+        :param parents: indices in the previous generation of the two parents of each individual
+        :type parents: array-like of shape (n, 2)
+        """
+        parents = np.asarray(parents)
+        # every individual mates only once, so the first parent identifies the family
+        _, first, family = np.unique(parents[:, 0], return_index=True, return_inverse=True)
+        pa, pb = self.family[parents[first, 0]], self.family[parents[first, 1]]
+        R = 0.5 * np.maximum.reduce([self.R[np.ix_(pa, pa)], self.R[np.ix_(pa, pb)],
+                                     self.R[np.ix_(pb, pa)], self.R[np.ix_(pb, pb)]])
+        R[R < 0.5 ** self.depth] = 0
+        np.fill_diagonal(R, 0.5)
+        self.R = R
+        self.family = family
+
+    def benefit(self, actor, recipients):
+        """
+        Benefit of an altruistic action: sum of the relatedness between the actor and each recipient
+
+        :param actor: index of the actor in the current generation
+        :type actor: int
+        :param recipients: indices of the recipients in the current generation, the actor excluded
+        :type recipients: array-like of int
+        :return: benefit
+        :rtype: float
         """
-        self.ig = ig.Graph.from_networkx(self.G)
\ No newline at end of file
+        return self.R[self.family[actor], self.family[recipients]].sum()
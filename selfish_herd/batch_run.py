@@ -1,6 +1,9 @@
+import os
+import sys
 from model import HerdModel
-from mesa.batchrunner import batch_run
-import pandas as pd
+# the batch runner is shared by all the scenarios and lives in the root of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from batch_stream import stream_batch_run
 
 if __name__ == '__main__':
     params = {"n_creatures": 200,  # range(50, 200, 10),
@@ -10,19 +13,18 @@ if __name__ == '__main__':
               "mr": 0.001,  # [0.001 * x for x in range(1, 2)],
               "width": 100, "height": 100}
 
-    results = batch_run(
+    stream_batch_run(
         HerdModel,
         parameters=params,
+        path="multi_result.csv",
         iterations=10,
         max_steps=1000,
         number_processes=None,
         data_collection_period=1,
         display_progress=True,
+        # True to complete an interrupted run of the same sweep instead of overwriting the output
+        resume=False,
     )
-
-    results_df = pd.DataFrame(results)
-
-    #results_df.to_csv("result.csv")
-    results_df.to_csv("multi_result.csv")
+    # path="result.csv" for the single parameters runs
 
     print("yeeee")
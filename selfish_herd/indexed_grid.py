@@ -0,0 +1,447 @@
+from array import array
+
+import numpy as np
+from mesa.space import MultiGrid
+
+# steps of the Moore neighborhood, in the order of the coordinates
+STEPS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+
+
+class IndexedGrid(MultiGrid):
+    """
+    MultiGrid keeping a numpy index of its content, updated every time an agent is placed, moved or removed:
+    - occupancy: number of agents in each cell
+    - layers: number of agents of each type in each cell, one layer for each type
+    - positions of the agents of each type, packed in an array
+
+    Neighborhood queries read the arrays of the cells within the radius instead of walking the lists of the grid.
+    The cells of a neighborhood are visited through offset tables sorted by Euclidean distance, so the agents are
+    found nearest first and given as displacements, across the edges when the grid wraps. Agents are told apart by
+    their type attribute.
+    """
+
+    def __init__(self, width, height, torus, types=("creature", "predator")):
+        """
+        :param width, height: The grid’s width and height
+        :type width, height: int
+        :param torus: whether the grid wraps or not
+        :type torus: bool
+        :param types: types of the agents living on the grid, defaults to ("creature", "predator")
+        :type types: tuple, optional
+        """
+        super().__init__(width, height, torus)
+        self.types = {t: i for i, t in enumerate(types)}
+        # the counters are updated one agent at a time through flat Python buffers, much cheaper than numpy scalar
+        # updates, and read by the queries through numpy views sharing the same memory
+        size = width * height
+        self._occupancy = array("i", bytes(4 * size))
+        self._layers = array("i", bytes(4 * size * len(types)))
+        self._layer_start = {t: i * size for t, i in self.types.items()}
+        self._flat_occupancy = np.frombuffer(self._occupancy, dtype=np.int32)
+        self._flat_layers = np.frombuffer(self._layers, dtype=np.int32).reshape(len(types), size)
+        self.occupancy = self._flat_occupancy.reshape(width, height)
+        self.layers = self._flat_layers.reshape(len(types), width, height)
+        # agents of each type with their positions, an agent is found through its slot
+        self._members = {t: [] for t in types}
+        self._coords = {t: np.zeros((16, 2), dtype=np.int64) for t in types}
+        self._slot = {}
+        # coordinates of the cells by flat index, offset tables by radius and displacement to best step table
+        self._cells = np.stack(np.divmod(np.arange(width * height), height), axis=1)
+        self._rings = {}
+        self._steps, self._step_reach = [], -1
+
+    def _place_agent(self, pos, agent):
+        x, y = pos
+        if agent not in self.grid[x][y]:
+            cell = x * self.height + y
+            self._occupancy[cell] += 1
+            self._layers[self._layer_start[agent.type] + cell] += 1
+        super()._place_agent(pos, agent)
+
+    def _remove_agent(self, pos, agent):
+        cell = pos[0] * self.height + pos[1]
+        self._occupancy[cell] -= 1
+        self._layers[self._layer_start[agent.type] + cell] -= 1
+        super()._remove_agent(pos, agent)
+
+    def is_cell_empty(self, pos):
+        return self._occupancy[pos[0] * self.height + pos[1]] == 0
+
+    def place_agent(self, agent, pos):
+        super().place_agent(agent, pos)
+        members, coords = self._members[agent.type], self._coords[agent.type]
+        if agent in self._slot:
+            coords[self._slot[agent]] = pos
+            return
+        if len(members) == len(coords):
+            coords = self._coords[agent.type] = np.concatenate([coords, np.zeros_like(coords)])
+        self._slot[agent] = len(members)
+        coords[len(members)] = pos
+        members.append(agent)
+
+    def remove_agent(self, agent):
+        # the last agent of the same type takes the slot of the removed one
+        members, coords = self._members[agent.type], self._coords[agent.type]
+        slot = self._slot.pop(agent)
+        last = members.pop()
+        if last is not agent:
+            members[slot] = last
+            coords[slot] = coords[len(members)]
+            self._slot[last] = slot
+        super().remove_agent(agent)
+
+    def move_agent(self, agent, pos):
+        super().move_agent(agent, pos)
+        coords, slot = self._coords[agent.type], self._slot[agent]
+        coords[slot, 0], coords[slot, 1] = agent.pos
+
+    def agents_of_type(self, type):
+        """
+        Agents of a type placed on the grid, in the same order of positions_of_type
+
+        :param type: type of the agents
+        :type type: str
+        :return: agents of the type
+        :rtype: list
+        """
+        return self._members[type]
+
+    def positions_of_type(self, type):
+        """
+        Positions of the agents of a type placed on the grid, in the same order of agents_of_type
+
+        :param type: type of the agents
+        :type type: str
+        :return: x and y coordinates of each agent, a view on the index
+        :rtype: np.ndarray of shape (n, 2)
+        """
+        return self._coords[type][:len(self._members[type])]
+
+    def place_agents_of_type(self, type, agents, positions):
+        """
+        Place many new agents of a type at once, see move_agents_of_type
+
+        :param type: type of the agents
+        :type type: str
+        :param agents: agents to be placed, not yet on the grid
+        :type agents: list
+        :param positions: x and y coordinates of the position of each agent
+        :type positions: np.ndarray of shape (n, 2)
+        """
+        members, coords = self._members[type], self._coords[type]
+        start, stop = len(members), len(members) + len(agents)
+        if stop > len(coords):
+            coords = self._coords[type] = np.concatenate([coords, np.zeros((stop, 2), dtype=coords.dtype)])
+        coords[start:stop] = positions
+        flat = positions[:, 0] * self.height + positions[:, 1]
+        np.add.at(self._flat_occupancy, flat, 1)
+        np.add.at(self._flat_layers[self.types[type]], flat, 1)
+
+        grid, empties, slots = self.grid, self.empties, self._slot
+        for slot, agent, pos in zip(range(start, stop), agents, map(tuple, positions.tolist())):
+            grid[pos[0]][pos[1]].append(agent)
+            empties.discard(pos)
+            agent.pos = pos
+            slots[agent] = slot
+        members.extend(agents)
+
+    def remove_agents_of_type(self, type, agents):
+        """
+        Remove many agents of a type at once, see move_agents_of_type. The agents left keep their order and
+        are packed in the slots at the beginning of the index
+
+        :param type: type of the agents
+        :type type: str
+        :param agents: agents to be removed
+        :type agents: list
+        """
+        members, coords = self._members[type], self._coords[type]
+        n = len(members)
+        removed = np.fromiter((self._slot.pop(agent) for agent in agents), dtype=np.int64, count=len(agents))
+        positions = coords[removed]
+        flat = positions[:, 0] * self.height + positions[:, 1]
+        np.subtract.at(self._flat_occupancy, flat, 1)
+        np.subtract.at(self._flat_layers[self.types[type]], flat, 1)
+
+        grid, empties = self.grid, self.empties
+        for agent in agents:
+            cell = grid[agent.pos[0]][agent.pos[1]]
+            cell.remove(agent)
+            if not cell:
+                empties.add(agent.pos)
+            agent.pos = None
+
+        keep = np.ones(n, dtype=bool)
+        keep[removed] = False
+        coords[:n - len(agents)] = coords[:n][keep]
+        members[:] = [agent for agent, k in zip(members, keep.tolist()) if k]
+        self._slot.update(zip(members, range(len(members))))
+
+    def move_agents_of_type(self, type, index, positions):
+        """
+        Move many agents of a type at once: the counters and the positions of the index are updated with a single
+        vectorized operation, the cells of the MultiGrid one agent at a time
+
+        :param type: type of the agents
+        :type type: str
+        :param index: slots of the agents, positions in agents_of_type
+        :type index: np.ndarray
+        :param positions: x and y coordinates of the new position of each agent
+        :type positions: np.ndarray of shape (n, 2)
+        """
+        members, coords = self._members[type], self._coords[type]
+        old = coords[index]
+        old_flat = old[:, 0] * self.height + old[:, 1]
+        new_flat = positions[:, 0] * self.height + positions[:, 1]
+        for counts in (self._flat_occupancy, self._flat_layers[self.types[type]]):
+            np.subtract.at(counts, old_flat, 1)
+            np.add.at(counts, new_flat, 1)
+        coords[index] = positions
+
+        grid, empties = self.grid, self.empties
+        for i, pos in zip(index.tolist(), map(tuple, positions.tolist())):
+            agent = members[i]
+            cell = grid[agent.pos[0]][agent.pos[1]]
+            cell.remove(agent)
+            if not cell:
+                empties.add(agent.pos)
+            grid[pos[0]][pos[1]].append(agent)
+            empties.discard(pos)
+            agent.pos = pos
+
+    def window_moments(self, counts, positions, radius):
+        """
+        Number of agents and sums of their displacements over the Moore neighborhoods of many cells at once, center
+        included. The counts are padded by the radius (wrapped copies of the opposite edges when the grid wraps),
+        so the displacements are measured across the edges, and summed through integral images.
+        With a radius wider than half the grid the cells wrapping onto the same cell are counted more than once
+
+        :param counts: number of agents in each cell
+        :type counts: np.ndarray of shape (width, height)
+        :param positions: x and y coordinates of the centers of the neighborhoods
+        :type positions: np.ndarray of shape (n, 2)
+        :param radius: radius of the neighborhoods
+        :type radius: int
+        :return: number of agents, sum of the x and of the y components of their displacements, for each cell
+        :rtype: np.ndarray of shape (n, 3)
+        """
+        padded = np.pad(counts, radius, mode="wrap" if self.torus else "constant").astype(np.int64)
+        # coordinates of the padded cells, the copies of the opposite edges are placed beyond the edges
+        x = np.arange(-radius, self.width + radius)[:, None]
+        y = np.arange(-radius, self.height + radius)[None, :]
+        integral = np.zeros((3, padded.shape[0] + 1, padded.shape[1] + 1), dtype=np.int64)
+        integral[:, 1:, 1:] = np.stack([padded, padded * x, padded * y]).cumsum(axis=1).cumsum(axis=2)
+
+        x, y = positions[:, 0], positions[:, 1]
+        side = 2 * radius + 1
+        sums = (integral[:, x + side, y + side] - integral[:, x, y + side]
+                - integral[:, x + side, y] + integral[:, x, y])
+        sums[1] -= x * sums[0]
+        sums[2] -= y * sums[0]
+        return sums.T
+
+    def displacement(self, pos, target):
+        """
+        Displacement from a cell to another one, across the edges of the grid if shorter when the grid wraps
+
+        :param pos: x and y coordinates of the starting cell
+        :type pos: tuple
+        :param target: x and y coordinates of the arrival cell
+        :type target: tuple
+        :return: x and y components of the displacement
+        :rtype: tuple
+        """
+        dx, dy = target[0] - pos[0], target[1] - pos[1]
+        if self.torus:
+            dx = (dx + self.width // 2) % self.width - self.width // 2
+            dy = (dy + self.height // 2) % self.height - self.height // 2
+        return dx, dy
+
+    def _ring_table(self, radius, include_center):
+        """
+        Offsets of the cells within the radius sorted by Euclidean distance, cached for each radius.
+        The flat index of the cells of the window is split in a column part, depending only on x, and a row part,
+        depending only on y; cells out of a grid which does not wrap get a negative index. The rings end at the
+        cells within distance 1, 2, 4, 8... so that a search walking outward can stop at the first ring with a hit
+
+        :return: offsets, column part for each x, row part for each y, end of each ring
+        :rtype: tuple
+        """
+        key = (radius, include_center)
+        table = self._rings.get(key)
+        if table is None:
+            dx, dy = np.meshgrid(np.arange(-radius, radius + 1), np.arange(-radius, radius + 1), indexing="ij")
+            keep = (dx != 0) | (dy != 0) | include_center
+            dx, dy = dx[keep], dy[keep]
+            d2 = dx ** 2 + dy ** 2
+            # ties are kept in the order of the coordinates
+            order = np.argsort(d2, kind="stable")
+            dx, dy, d2 = dx[order], dy[order], d2[order]
+            x = np.arange(self.width)[:, None] + dx
+            y = np.arange(self.height)[:, None] + dy
+            columns, rows = (x % self.width) * self.height, y % self.height
+            if not self.torus:
+                outside = -2 * self.width * self.height
+                columns[(x < 0) | (x >= self.width)] = outside
+                rows[(y < 0) | (y >= self.height)] = outside
+            ends = np.searchsorted(d2, 4 ** np.arange(int(np.log2(max(radius, 1))) + 1), side="right")
+            ends = np.unique(np.append(ends, len(d2)))
+            table = self._rings[key] = (np.stack([dx, dy], axis=1), columns, rows, ends)
+        return table
+
+    def _ring(self, pos, radius, include_center=False):
+        """
+        Cells within the radius of a cell, nearest first
+
+        :param pos: x and y coordinates of the cell
+        :type pos: tuple
+        :param radius: radius of the neighborhood
+        :type radius: int
+        :param include_center: include the cell itself
+        :type include_center: bool
+        :return: offsets of the cells and flat index of the cells in the grid arrays (x * height + y)
+        :rtype: tuple of np.ndarray
+        """
+        offsets, columns, rows, _ = self._ring_table(radius, include_center)
+        flat = columns[pos[0]] + rows[pos[1]]
+        if not self.torus:
+            inside = flat >= 0
+            return offsets[inside], flat[inside]
+        if 2 * radius + 1 > min(self.width, self.height):
+            # the window wraps over the whole grid, each cell is kept once through its shortest offset
+            _, first = np.unique(flat, return_index=True)
+            first.sort()
+            return offsets[first], flat[first]
+        return offsets, flat
+
+    def empty_neighborhood(self, pos, radius=1):
+        """
+        Empty cells of the Moore neighborhood of a cell, center excluded
+
+        :param pos: x and y coordinates of the cell
+        :type pos: tuple
+        :param radius: radius of the neighborhood, defaults to 1
+        :type radius: int, optional
+        :return: coordinates of the empty cells, in the order of MultiGrid.get_neighborhood
+        :rtype: list of tuple
+        """
+        if radius <= 2:
+            # small neighborhoods are cheaper to walk through the neighborhood cache of MultiGrid
+            occupancy, height = self._occupancy, self.height
+            return [c for c in self.get_neighborhood(pos, moore=True, radius=radius)
+                    if not occupancy[c[0] * height + c[1]]]
+        _, flat = self._ring(pos, radius)
+        flat = np.sort(flat[self._flat_occupancy.take(flat) == 0])
+        return list(map(tuple, self._cells[flat].tolist()))
+
+    def neighbors(self, pos, radius=1, include_center=False):
+        """
+        Displacements of the agents of each type within the Moore neighborhood of a cell, nearest first.
+        A displacement is repeated for each agent in the cell, as the agents of MultiGrid.get_neighbors
+
+        :param pos: x and y coordinates of the cell
+        :type pos: tuple
+        :param radius: radius of the neighborhood, defaults to 1
+        :type radius: int, optional
+        :param include_center: include the agents in the cell itself, defaults to False
+        :type include_center: bool, optional
+        :return: x and y components of the displacement of each agent, for each type
+        :rtype: dict of np.ndarray of shape (n, 2)
+        """
+        offsets, flat = self._ring(pos, radius, include_center)
+        counts = self._flat_layers[:, flat]
+        return {t: np.repeat(offsets, counts[i], axis=0) for t, i in self.types.items()}
+
+    def neighbors_of_type(self, pos, type, radius=1, include_center=False):
+        """
+        Displacements of the agents of a type within the Moore neighborhood of a cell, see neighbors
+
+        :param pos: x and y coordinates of the cell
+        :type pos: tuple
+        :param type: type of the agents
+        :type type: str
+        :param radius: radius of the neighborhood, defaults to 1
+        :type radius: int, optional
+        :param include_center: include the agents in the cell itself, defaults to False
+        :type include_center: bool, optional
+        :return: x and y components of the displacement of each agent
+        :rtype: np.ndarray of shape (n, 2)
+        """
+        offsets, flat = self._ring(pos, radius, include_center)
+        return np.repeat(offsets, self._flat_layers[self.types[type]].take(flat), axis=0)
+
+    def nearest_of_type(self, pos, type, radius=1):
+        """
+        Displacement of the nearest agent of a type within the Moore neighborhood of a cell, center excluded.
+        The search walks outward one ring at a time and stops at the first ring holding an agent of the type
+
+        :param pos: x and y coordinates of the cell
+        :type pos: tuple
+        :param type: type of the agents
+        :type type: str
+        :param radius: radius of the neighborhood, defaults to 1
+        :type radius: int, optional
+        :return: x and y components of the displacement of the nearest agent, None if there is none
+        :rtype: tuple
+        """
+        offsets, columns, rows, ends = self._ring_table(radius, False)
+        layer = self._flat_layers[self.types[type]]
+        columns, rows = columns[pos[0]], rows[pos[1]]
+        start = 0
+        for end in ends:
+            flat = columns[start:end] + rows[start:end]
+            counts = layer.take(flat, mode="clip")
+            if not self.torus:
+                counts[flat < 0] = 0
+            hits = np.flatnonzero(counts)
+            if len(hits):
+                return tuple(offsets[start + hits[0]].tolist())
+            start = end
+        return None
+
+    def _step_table(self, reach):
+        """
+        Displacement to best step table: for each integer displacement within the reach, the steps of the Moore
+        neighborhood sorted by distance from the displacement, ties in the order of the coordinates
+
+        :param reach: maximum component of the displacements
+        :type reach: int
+        :return: sorted steps for each displacement, indexed by (dx + reach, dy + reach)
+        :rtype: list of list of tuple
+        """
+        if reach > self._step_reach:
+            self._step_reach = reach
+            displacements = range(-reach, reach + 1)
+            self._steps = [[sorted(STEPS, key=lambda s: (s[0] - vx) ** 2 + (s[1] - vy) ** 2)
+                            for vy in displacements] for vx in displacements]
+        return self._steps
+
+    def best_step(self, pos, displacement):
+        """
+        Empty cell of the Moore neighborhood of a cell nearest to the cell at the given displacement; integer
+        displacements are looked up in the displacement to best step table
+
+        :param pos: x and y coordinates of the cell
+        :type pos: tuple
+        :param displacement: x and y components of the displacement of the target
+        :type displacement: tuple
+        :return: coordinates of the best step, None if all the cells of the neighborhood are occupied
+        :rtype: tuple
+        """
+        vx, vy = displacement
+        if vx == int(vx) and vy == int(vy):
+            vx, vy = int(vx), int(vy)
+            table = self._step_table(max(abs(vx), abs(vy)))
+            steps = table[vx + self._step_reach][vy + self._step_reach]
+        else:
+            steps = sorted(STEPS, key=lambda s: (s[0] - vx) ** 2 + (s[1] - vy) ** 2)
+        x, y = pos
+        for sx, sy in steps:
+            cell = (x + sx, y + sy)
+            if self.torus:
+                cell = (cell[0] % self.width, cell[1] % self.height)
+            elif self.out_of_bounds(cell):
+                continue
+            if not self._occupancy[cell[0] * self.height + cell[1]]:
+                return cell
+        return None
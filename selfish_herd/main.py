@@ -56,6 +56,7 @@ if __name__ == '__main__':
                             "prey_sight": UserSettableParameter("slider", "Prey sight", 5, 0, 10, 1),
                             "jump_range": UserSettableParameter("slider", "Jump_range", 3, 0, 10, 1),
                             "mr": UserSettableParameter("slider", "Mutation rate", 0.001, 0, 0.01, 0.001),
+                            "sync": UserSettableParameter("checkbox", "Synchronous creatures", False),
                             "width": 100, "height": 100})
 
     server.port = 8521  # The default
@@ -1,9 +1,16 @@
-import random
+import os
+import sys
+import numpy as np
 from mesa import Agent, Model
 from mesa.time import RandomActivation
-from mesa.space import MultiGrid
 from mesa.datacollection import DataCollector
 from math import sqrt
+from indexed_grid import IndexedGrid, STEPS
+
+# the scheduler mixins are shared by all the scenarios and live in the root of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from social_activation import BulkSchedule
+
 
 dist = lambda x, y: sqrt(((x[0] - y[0]) ** 2) + ((x[1] - y[1]) ** 2))
 mov_vectorize = lambda x, y: [coord[0] - coord[1] for coord in zip(x, y)]
@@ -54,41 +61,35 @@ class PredatorAgent(Agent):
         Scenario 2 - no creatures in the sight radius, random move
         """
 
-        all_possible_steps = self.model.grid.get_neighborhood(self.pos, moore=True, include_center=False)
-        possible_steps = [x for x in all_possible_steps if self.model.grid.is_cell_empty(x)]
-
-        nb = self.model.grid.get_neighbors(self.pos, moore=True, include_center=False, radius=self.sight)
-        nb = [x.pos for x in nb if x.type == "creature"]
+        # displacement of the nearest creature, the search stops at the first creature found
+        nearest_prey = self.model.grid.nearest_of_type(self.pos, "creature", radius=self.sight)
 
         # Scenario 1
-        if nb:
-            nearest_prey = min(nb, key=lambda x: sqrt(((self.pos[0] - x[0]) ** 2) + ((self.pos[1] - x[1]) ** 2)))
-            if dist(nearest_prey, self.pos) < self.jump_range:
+        if nearest_prey:
+            if dist(nearest_prey, (0, 0)) < self.jump_range:
                 self.hunt(nearest_prey)
 
             else:
-                if possible_steps:
-                    new_position = self.chase(nearest_prey, possible_steps)
+                new_position = self.chase(nearest_prey)
+                if new_position:
                     self.model.grid.move_agent(self, new_position)
 
         # Scenario 2
         else:
+            possible_steps = self.model.grid.empty_neighborhood(self.pos)
             new_position = self.random.choice(possible_steps)
             self.model.grid.move_agent(self, new_position)
 
-    def chase(self, nearest_prey, possible_steps):
+    def chase(self, nearest_prey):
         """
-        Implementation of agent chasing action.
+        Implementation of agent chasing action: the agent moves to the empty neighbour cell nearest to the creature.
 
-        :param nearest_prey: position of the nearest creature, namely x and y coordinates
+        :param nearest_prey: displacement of the nearest creature, namely x and y components
         :type nearest_prey: tuple
-        :param possible_steps: all possible cells in which the agent can move defined by x and y coordinates
-        :type np: tuple
+        :return: new position, None if all the neighbour cells are occupied
+        :rtype: tuple
         """
-        move_vector = mov_vectorize(self.pos, nearest_prey)
-        vect_landing = [coord[0] - coord[1] for coord in zip(self.pos, move_vector)]
-        return min(possible_steps, key=lambda x: sqrt(
-            ((vect_landing[0] - x[0]) ** 2) + ((vect_landing[1] - x[1]) ** 2)))
+        return self.model.grid.best_step(self.pos, nearest_prey)
 
     def eat(self):
         """
@@ -104,15 +105,14 @@ class PredatorAgent(Agent):
 
     def hunt(self, np):
         """
-        Implementation of agent hunting action.
+        Implementation of agent hunting action: the agent jumps to the cell within distance 4 nearest to the creature.
 
-        :param np: position of the nearest creature, namely x and y coordinates
-        :type np: tuple
+        :param np: displacement of the nearest creature, namely x and y components
         :type np: tuple
         """
-        possible_steps = self.model.grid.get_neighborhood(self.pos, moore=True, include_center=False, radius=4)
-        new_position = min(possible_steps, key=lambda x: sqrt(((np[0] - x[0]) ** 2) + ((np[1] - x[1]) ** 2)))
-        self.model.grid.move_agent(self, new_position)
+        # the nearest cell of the jump square is the displacement clipped to the square
+        jump = [max(-4, min(4, coord)) for coord in np]
+        self.model.grid.move_agent(self, (self.pos[0] + jump[0], self.pos[1] + jump[1]))
         self.eat()
 
 
@@ -144,9 +144,12 @@ class PreyAgent(Agent):
         """
         A single step of the agent which consists in moving.
         The agent moves only if there is at least one empty cell in neighbour cells.
+        With the synchronous update of the model the creatures are moved all together by the model.
         """
-        all_possible_steps = self.model.grid.get_neighborhood(self.pos, moore=True, include_center=False)
-        possible_steps = [x for x in all_possible_steps if self.model.grid.is_cell_empty(x)]
+        if self.model.sync:
+            return
+
+        possible_steps = self.model.grid.empty_neighborhood(self.pos)
 
         if possible_steps:
             self.move(possible_steps)
@@ -171,12 +174,13 @@ class PreyAgent(Agent):
         Scenario 2 - no agents in the sight radius, random move
         """
 
-        np = self.model.grid.get_neighbors(self.pos, moore=True, include_center=False, radius=self.sight)
-        npredator = [x.pos for x in np if x.type == "predator"]
-        nprey = [x.pos for x in np if x.type == "creature"]
+        # displacements of the agents in the sight radius, nearest first
+        nb = self.model.grid.neighbors(self.pos, radius=self.sight)
+        npredator = nb["predator"]
+        nprey = nb["creature"]
 
         fear_vect = None
-        if npredator:
+        if len(npredator) > 0:
             fear_vect = self.panic(npredator)
 
         # Scenario 1
@@ -184,18 +188,14 @@ class PreyAgent(Agent):
             move_vect = None
 
             if len(nprey) > 0:
-                prey_cm_x = sum(x[0] for x in nprey) / len(nprey)
-                prey_cm_y = sum(y[1] for y in nprey) / len(nprey)
-                cm_vect = [prey_cm_x, prey_cm_y]
-                move_vect = mov_vectorize(self.pos, cm_vect)
+                cm_vect = nprey.mean(axis=0).tolist()
+                move_vect = mov_vectorize((0, 0), cm_vect)
                 move_vect = [round(self.genotype[0] * x, 2) for x in move_vect]
 
             if fear_vect:
                 move_vect = fear_vect
 
-            vect_landing = [coord[0] - coord[1] for coord in zip(self.pos, move_vect)]
-            new_position = min(possible_steps, key=lambda x: sqrt(
-                ((vect_landing[0] - x[0]) ** 2) + ((vect_landing[1] - x[1]) ** 2)))
+            new_position = self.model.grid.best_step(self.pos, [-coord for coord in move_vect])
 
         # Scenario 2
         else:
@@ -207,29 +207,20 @@ class PreyAgent(Agent):
         """
         Implementation of fear vector, namely the distance between the creature and the nearest predator.
 
-        :param npredator: positions (x and y coordinates) of all predators in the sight radius of the agent
-        :type npredator: tuple
+        :param npredator: displacements (x and y components) of all predators in the sight radius of the agent,
+        nearest first
+        :type npredator: np.ndarray
         """
 
-        nearest_predator = min(npredator,
-                               key=lambda x: sqrt(((self.pos[0] - x[0]) ** 2) + ((self.pos[1] - x[1]) ** 2)))
-        return mov_vectorize([x for x in nearest_predator], self.pos)
+        nearest_predator = npredator[0].tolist()
+        return mov_vectorize(nearest_predator, (0, 0))
 
-def mutation(genotype, k):
 
+class HerdActivation(BulkSchedule, RandomActivation):
     """
-    Implementation of mutation function that applies a shift to the genotype value
-
-    :param genotype: genotype to mutate
-    :type genotype: list
-    :param k: maximum mutation shift
-    :type k: float
+    Random activation with the bulk operations used to add and remove whole generations of PreyAgents
     """
 
-    ub = genotype[0] + k if genotype[0] + k < 1 else 1
-    lb = genotype[0] - k if genotype[0] - k > -1 else -1
-    new_genotype = [random.uniform(ub, lb)]
-    return new_genotype
 
 class HerdModel(Model):
     """
@@ -239,7 +230,8 @@ class HerdModel(Model):
     :type Model: mesa.model
     """
 
-    def __init__(self, n_creatures: int, n_pred: int, jump_range: int, mr: int, prey_sight=5, predator_sight=5, width=100, height=100):
+    def __init__(self, n_creatures: int, n_pred: int, jump_range: int, mr: int, prey_sight=5, predator_sight=5, width=100, height=100,
+                 sync=False, tie_break="random"):
         """
         HerdModel init function
 
@@ -257,6 +249,12 @@ class HerdModel(Model):
         :type predator_sight: int
         :param width, height: The mesa grid’s width and height
         :type width, height: int
+        :param sync: synchronous update of the PreyAgents, all moved together by the model before the activation of
+        the PredatorAgents, defaults to False
+        :type sync: bool, optional
+        :param tie_break: with the synchronous update, choice of the creature moving when more creatures aim at the
+        same cell, "random" or "id" (the lowest unique_id), defaults to "random"
+        :type tie_break: str, optional
         """
 
         self.num_agents = n_creatures
@@ -265,8 +263,11 @@ class HerdModel(Model):
         self.predator_sight = predator_sight
         self.mr = mr
         self.jump_range = jump_range
-        self.schedule = RandomActivation(self)
-        self.grid = MultiGrid(width, height, True)
+        self.sync = sync
+        self.tie_break = tie_break
+        self.rng = np.random.default_rng(self._seed)
+        self.schedule = HerdActivation(self)
+        self.grid = IndexedGrid(width, height, True, types=("creature", "predator"))
         self.current_id = 0
 
         self.running = True
@@ -297,23 +298,8 @@ class HerdModel(Model):
         :type num_pred: int
         """
 
-        # adding selfish PreyAgents (genotype = 1)
-        for i in range(0, num_agents // 2):
-            a = PreyAgent(self.next_id(), self, genotype=[1], type="creature", sight=self.prey_sight)
-            self.schedule.add(a)
-            # Add the agent to a random grid cell
-            x = self.random.randrange(self.grid.width)
-            y = self.random.randrange(self.grid.height)
-            self.grid.place_agent(a, (x, y))
-
-        # adding non-selfish PreyAgents (genotype = -1)
-        for i in range(0, num_agents // 2):
-            a = PreyAgent(self.next_id(), self, genotype=[-1], type="creature", sight=self.prey_sight)
-            self.schedule.add(a)
-            # Add the agent to a random grid cell
-            x = self.random.randrange(self.grid.width)
-            y = self.random.randrange(self.grid.height)
-            self.grid.place_agent(a, (x, y))
+        # adding selfish PreyAgents (genotype = 1) and non-selfish PreyAgents (genotype = -1) in random grid cells
+        self.spawn_creatures(np.repeat([1, -1], num_agents // 2))
 
         for i in range(0, num_pred):
             a = PredatorAgent(self.next_id(), self, type="predator", sight= self.predator_sight, jump_range=self.jump_range)
@@ -323,53 +309,176 @@ class HerdModel(Model):
             y = self.random.randrange(self.grid.height)
             self.grid.place_agent(a, (x, y))
 
+    def spawn_creatures(self, genotypes):
+        """
+        Add many PreyAgents at once, in random grid cells: the agents are added to the scheduler and to the grid
+        with a single bulk operation
+
+        :param genotypes: genotype of each new PreyAgent
+        :type genotypes: np.ndarray
+        :return: the new agents
+        :rtype: list
+        """
+        n = len(genotypes)
+        first_id = self.current_id + 1
+        self.current_id += n
+        agents = [PreyAgent(unique_id, self, genotype=[g], type="creature", sight=self.prey_sight)
+                  for unique_id, g in zip(range(first_id, first_id + n), np.asarray(genotypes, dtype=float).tolist())]
+        positions = np.stack([self.rng.integers(self.grid.width, size=n), self.rng.integers(self.grid.height, size=n)],
+                             axis=1)
+        self.schedule.add_many(agents)
+        self.grid.place_agents_of_type("creature", agents, positions)
+        return agents
+
+    def remove_creatures(self, agents):
+        """
+        Remove many PreyAgents at once from the scheduler and from the grid
+
+        :param agents: agents to be removed
+        :type agents: list
+        """
+        self.schedule.remove_many(agents)
+        self.grid.remove_agents_of_type("creature", agents)
+
     def reproduce(self, max_child=4):
         """
-        Function to generate the new population from the parent PreyAgents
-        1. Sample PreyAgents from current population and generate pairs of individuals
-        2. Create the new generation within a range, defining inherited genotype (mutation applied)
+        Function to generate the new population from the parent PreyAgents, the whole generation at once
+        1. Shuffle the current PreyAgents and generate pairs of individuals
+        2. Draw the number of children of each pair and define their inherited genotype (mutation applied)
         3. Add the new generation of agents to the model and to the grid (in a random position)
-        4. Remove all the "old" agents from the model and the grid
+        4. Remove all the "old" agents from the model and the grid, with an odd number of PreyAgents the unpaired
+           one survives
         """
 
         # 1
-        preys = [agent for agent in self.schedule.agents if agent.type == "creature"]
-        prey_agents = random.sample(preys, k=len(preys))
+        preys = self.grid.agents_of_type("creature")
+        genotype = np.fromiter((a.genotype[0] for a in preys), dtype=float, count=len(preys))
+        order = self.rng.permutation(len(preys))
+        half = len(order) // 2
+        agent1 = order[0:2 * half:2]
+        agent2 = order[1:2 * half:2]
 
         # 2
-        for i in range(0, len(prey_agents) - 1, 2):
-            agent1 = prey_agents[i]
-            agent2 = prey_agents[i + 1]
-            n_child = random.randint(2, max_child)
+        n_child = self.rng.integers(2, max_child + 1, size=half)
+        p1 = np.repeat(agent1, n_child)
+        p2 = np.repeat(agent2, n_child)
+        child = np.where(self.rng.random(len(p1)) < 0.5, genotype[p1], genotype[p2])
 
-            for j in range(n_child):
-                gen1 = [agent1.genotype[0] if random.random() < 0.50 else agent2.genotype[0]]
+        # Mutation: uniform shift within 0.2, the genotype stays in [-1,1]
+        mutate = self.rng.random(len(child)) < self.mr
+        lb = np.maximum(child[mutate] - 0.2, -1)
+        ub = np.minimum(child[mutate] + 0.2, 1)
+        child[mutate] = self.rng.uniform(lb, ub)
 
-                # Mutation
-                if random.random() < self.mr:  # random mutation
-                    gen1 = mutation(gen1, 0.2)
+        # 3
+        parents = [preys[i] for i in order[:2 * half].tolist()]
+        self.spawn_creatures(child)
 
-                child = PreyAgent(self.next_id(), self, genotype=gen1, type="creature", sight=self.prey_sight)
+        # 4
+        self.remove_creatures(parents)
+
+    def move_creatures(self):
+        """
+        Synchronous move of all the PreyAgents, see PreyAgent.move: the moves are computed from the positions at the
+        beginning of the step and applied all together
+        1. Empty neighbour cells of each creature, the creatures without empty neighbour cells do not move
+        2. Center of mass of the other creatures in the sight radius, weighted by the genotype
+        3. Fear vector of the nearest predator in the sight radius
+        4. Empty neighbour cell nearest to the landing point, a random one for the creatures seeing no other agent
+        5. Only one of the creatures aiming at the same cell moves, chosen according to tie_break
+        6. Apply all the moves
+        """
+        grid = self.grid
+        agents = grid.agents_of_type("creature")
+        n = len(agents)
+        if n == 0:
+            return
+        pos = grid.positions_of_type("creature").copy()
+        genotype = np.fromiter((a.genotype[0] for a in agents), dtype=float, count=n)
+        size = np.array([grid.width, grid.height])
+        steps = np.array(STEPS)
+        sight = self.prey_sight
 
-                # 3
-                self.schedule.add(child)
+        # 1
+        cells = pos[:, None, :] + steps
+        if grid.torus:
+            cells %= size
+        inside = ((cells >= 0) & (cells < size)).all(axis=2)
+        clipped = np.minimum(np.maximum(cells, 0), size - 1)
+        empty = inside & (grid.occupancy[clipped[..., 0], clipped[..., 1]] == 0)
 
-                x = self.random.randrange(self.grid.width)
-                y = self.random.randrange(self.grid.height)
-                self.grid.place_agent(child, (x, y))
+        # 2
+        layer = grid.layers[grid.types["creature"]]
+        count, sum_x, sum_y = grid.window_moments(layer, pos, sight).T
+        # the creatures in the same cell are not seen, their displacement is null
+        count = count - layer[pos[:, 0], pos[:, 1]]
+        seen = count > 0
+        target = np.zeros((n, 2))
+        cm_vect = np.stack([sum_x[seen], sum_y[seen]], axis=1) / count[seen, None]
+        target[seen] = -np.round(genotype[seen, None] * -cm_vect, 2)
+
+        # 3
+        # the creatures seeing a predator are the ones in the cells of the neighborhood of the predator, found in
+        # the creatures sorted by cell; the nearest predator has the lowest key, with ties in the order of the
+        # coordinates as in the offset tables of the grid, and the key encodes the displacement of the predator
+        predators = grid.positions_of_type("predator")
+        side = 2 * sight + 1
+        nearest = np.full(n, side ** 4, dtype=np.int64)
+        if len(predators):
+            d = np.stack(np.meshgrid(np.arange(-sight, sight + 1), np.arange(-sight, sight + 1), indexing="ij"),
+                         axis=-1).reshape(-1, 2)
+            d = d[(d != 0).any(axis=1)]
+            around = predators[:, None, :] - d
+            if grid.torus:
+                around %= size
+            valid = ((around >= 0) & (around < size)).all(axis=2)
+            flat = (around[..., 0] * grid.height + around[..., 1])[valid]
+            key = (((d ** 2).sum(axis=1) * side + d[:, 0] + sight) * side + d[:, 1] + sight)
+            key = np.broadcast_to(key, valid.shape)[valid]
+
+            creature_flat = pos[:, 0] * grid.height + pos[:, 1]
+            by_cell = np.argsort(creature_flat, kind="stable")
+            lo = np.searchsorted(creature_flat[by_cell], flat, side="left")
+            hi = np.searchsorted(creature_flat[by_cell], flat, side="right")
+            found = hi - lo
+            start = np.repeat(lo - np.cumsum(found) + found, found)
+            seeing = by_cell[start + np.arange(found.sum())]
+            np.minimum.at(nearest, seeing, np.repeat(key, found))
+        afraid = nearest < side ** 4
+        target[afraid, 0] = -(nearest[afraid] // side % side - sight)
+        target[afraid, 1] = -(nearest[afraid] % side - sight)
+
+        # 4
+        aware = seen | afraid
+        key = np.where(aware[:, None], ((steps - target[:, None, :]) ** 2).sum(axis=2), self.rng.random((n, len(steps))))
+        key[~empty] = np.inf
+        choice = key.argmin(axis=1)
+        movers = np.flatnonzero(empty.any(axis=1))
+        new_pos = cells[movers, choice[movers]]
+
+        # 5
+        flat = new_pos[:, 0] * grid.height + new_pos[:, 1]
+        if self.tie_break == "random":
+            priority = self.rng.permutation(len(movers))
+        else:
+            priority = np.fromiter((agents[i].unique_id for i in movers), dtype=np.int64, count=len(movers))
+        order = np.lexsort((priority, flat))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = flat[order][1:] != flat[order][:-1]
+        winners = order[first]
 
-            # 4
-            self.schedule.remove(agent1)
-            self.schedule.remove(agent2)
-            self.grid.remove_agent(agent1)
-            self.grid.remove_agent(agent2)
+        # 6
+        grid.move_agents_of_type("creature", movers[winners], new_pos[winners])
 
     def step(self):
         """
         Model step
+        With the synchronous update the creatures move all together, then the agents are activated.
         Reproduction is performed every time the number of creatures reaches a threshold.
         """
 
+        if self.sync:
+            self.move_creatures()
         self.schedule.step()
 
         n_creature = len([agent for agent in self.schedule.agents if agent.type == "creature"])
@@ -0,0 +1,217 @@
+from collections import Counter, OrderedDict
+from mesa.time import BaseScheduler
+
+
+class BulkSchedule:
+    """
+    Mixin adding bulk operations to a Mesa scheduler: a whole generation of agents is added, removed or
+    swapped at once instead of calling add and remove for every agent.
+    get_agent_count and agent_buffer keep the same semantics, agents are kept in the order they were added.
+
+    Must be mixed in before the Mesa scheduler class, e.g. class Scheduler(BulkSchedule, RandomActivation)
+    """
+
+    @staticmethod
+    def _index(agents):
+        """
+        Ordered unique_id -> agent index of a list of agents
+
+        :param agents: agents to be indexed
+        :type agents: iterable of mesa.agent
+        :return: the index
+        :rtype: OrderedDict
+        """
+        index = OrderedDict((agent.unique_id, agent) for agent in agents)
+        if len(index) != len(agents):
+            raise Exception("Agents with duplicated unique id added to scheduler")
+        return index
+
+    def add_many(self, agents) -> None:
+        """
+        Add a list of agents to the schedule, after the agents already in it
+
+        :param agents: agents to be added
+        :type agents: list of mesa.agent
+        """
+        index = self._index(agents)
+        if not index.keys().isdisjoint(self._agents):
+            raise Exception("Agent with unique id already added to scheduler")
+        self._agents.update(index)
+
+    def remove_many(self, agents) -> None:
+        """
+        Remove a list of agents from the schedule
+
+        :param agents: agents to be removed
+        :type agents: iterable of mesa.agent
+        """
+        for agent in agents:
+            del self._agents[agent.unique_id]
+
+    def swap_generation(self, agents) -> None:
+        """
+        Replace all the agents in the schedule with a new generation, the old one is dropped at once
+
+        :param agents: agents of the new generation
+        :type agents: list of mesa.agent
+        """
+        self._agents = self._index(agents)
+
+
+class ClassCount:
+    """
+    Mixin keeping the number of agents of each class (e.g. genotype) in a Mesa scheduler. The class of an agent
+    is given by a key function and must not change while the agent is in the schedule; the counters are updated
+    every time agents are added or removed, so reading them does not require a scan of the population.
+    With debug enabled every reading of the counters is cross-checked against a full scan.
+
+    Must be mixed in before BulkSchedule and the Mesa scheduler class,
+    e.g. class Scheduler(ClassCount, BulkSchedule, BaseScheduler)
+    """
+
+    def __init__(self, model, key=None, debug=False) -> None:
+        """
+        :param model: the model the scheduler belongs to
+        :type model: mesa.model
+        :param key: function returning the class of an agent, None to not keep any counter, defaults to None
+        :type key: callable, optional
+        :param debug: cross-check the counters against a full scan each time they are read, defaults to False
+        :type debug: bool, optional
+        """
+        super().__init__(model)
+        self.key = key
+        self.debug = debug
+        self.class_counts = Counter()
+
+    def add(self, agent) -> None:
+        super().add(agent)
+        if self.key is not None:
+            self.class_counts[self.key(agent)] += 1
+
+    def remove(self, agent) -> None:
+        super().remove(agent)
+        if self.key is not None:
+            self.class_counts[self.key(agent)] -= 1
+
+    def add_many(self, agents) -> None:
+        super().add_many(agents)
+        if self.key is not None:
+            self.class_counts.update(map(self.key, agents))
+
+    def remove_many(self, agents) -> None:
+        agents = list(agents)
+        super().remove_many(agents)
+        if self.key is not None:
+            self.class_counts.subtract(map(self.key, agents))
+
+    def swap_generation(self, agents) -> None:
+        super().swap_generation(agents)
+        if self.key is not None:
+            self.class_counts = Counter(map(self.key, agents))
+
+    def class_count(self, *classes):
+        """
+        Number of agents in the schedule belonging to the given classes
+
+        :param classes: classes of agents, as returned by the key function
+        :return: number of agents
+        :rtype: int
+        """
+        if self.debug:
+            self.check_counts()
+        return sum(self.class_counts[c] for c in classes)
+
+    def check_counts(self) -> None:
+        """
+        Cross-check the counters against a full scan of the agents in the schedule
+        """
+        scan = Counter(map(self.key, self._agents.values()))
+        if +self.class_counts != scan:
+            raise Exception(f"Class counters {dict(+self.class_counts)} do not match the agents in the schedule "
+                            f"{dict(scan)}")
+
+
+class SocialActivation(ClassCount, BulkSchedule, BaseScheduler):
+    """
+    A scheduler which activates only the actors of the step, once each and in random order.
+    Actors are looked up directly by their unique id, so the cost of a step depends on the number
+    of actors and not on the size of the population.
+    Agents removed while the step is running are not activated anymore but they are actually deleted
+    from the schedule only at the end of the step, so that the agents can safely remove each other.
+
+    Shared by the kinship and the green beard models.
+
+    :param ClassCount: counters of the agents of each class, e.g. genotype
+    :param BulkSchedule: bulk operations to add, remove and swap whole generations of agents
+    :param BaseScheduler: activates agents one at a time, in the order they were added.
+    Assumes that each agent added has a step method which takes no arguments.
+    """
+
+    def __init__(self, model, key=None, debug=False) -> None:
+        super().__init__(model, key=key, debug=debug)
+        self._stepping = False
+        # unique_id -> agent removed during the current step
+        self._removed = {}
+
+    def get_agent(self, unique_id):
+        """
+        Agent in the schedule with the given unique id
+
+        :param unique_id: unique id of the agent
+        :type unique_id: int
+        :return: the agent
+        :rtype: mesa.agent
+        """
+        return self._agents[unique_id]
+
+    def remove(self, agent) -> None:
+        """
+        Remove an agent from the schedule. During a step the removal is deferred until all the actors
+        have been activated.
+
+        :param agent: agent to be removed
+        :type agent: mesa.agent
+        """
+        if self._stepping:
+            self._removed[agent.unique_id] = agent
+        else:
+            super().remove(agent)
+
+    def remove_many(self, agents) -> None:
+        """
+        Remove a list of agents from the schedule. During a step the removal is deferred until all the actors
+        have been activated.
+
+        :param agents: agents to be removed
+        :type agents: iterable of mesa.agent
+        """
+        if self._stepping:
+            self._removed.update((agent.unique_id, agent) for agent in agents)
+        else:
+            super().remove_many(agents)
+
+    def step(self, actors) -> None:
+        """
+        Executes the step of the actors, one at a time, in random order.
+        Duplicated ids and ids of agents not in the schedule are ignored.
+
+        :param actors: unique ids of the agents to be activated
+        :type actors: iterable of int
+        """
+        actors = list(dict.fromkeys(actors))
+        self.model.random.shuffle(actors)
+
+        self._stepping = True
+        try:
+            for unique_id in actors:
+                agent = self._agents.get(unique_id)
+                if agent is not None and unique_id not in self._removed:
+                    agent.step()
+        finally:
+            self._stepping = False
+            for agent in self._removed.values():
+                super().remove(agent)
+            self._removed.clear()
+
+        self.steps += 1
+        self.time += 1